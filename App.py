@@ -36,6 +36,8 @@
 import pygtk
 pygtk.require('2.0')
 import gtk
+import pango
+import gobject
 import os
 import sys
 import yaml
@@ -45,6 +47,7 @@ from Button import RCButton
 
 # Import the application specific library.
 import rokulib
+import rokucore
 
 # Import the layout function for the specific application.
 from rokulib import send_text
@@ -67,16 +70,13 @@ class App( object ):
        # Initialize threads.
        gtk.gdk.threads_init()
  
-       self.config_path = op.join(op.expanduser('~'), '.roku_remote')
+       self.config_path = rokucore.CONFIG_PATH
 
+       # The file locations are shared with the command line remote.
+       self.config_files  = rokucore.get_config_files( self.config_path )
        self.icon_file     = op.join(self.config_path, 'icons', 'roku.svg')
-       self.device_file   = op.join(self.config_path, 'default_device.yml')
-       self.launcher_file = op.join(self.config_path, 'launchers.yml')
- 
-       self.config_files = {
-           'device': self.device_file,
-           'launcher': self.launcher_file,
-       }
+       self.device_file   = self.config_files['device']
+       self.launcher_file = self.config_files['launcher']
  
        # Set the default main window size.
        self.main_window = gtk.Window( gtk.WINDOW_TOPLEVEL )
@@ -108,10 +108,25 @@ class App( object ):
  
        # Lay the buttons out.
        self.layout_buttons()
+
+       # The latency readout stays hidden until asked for.
+       self.layout_stats()
+
+       # Keep an eye on the selected Roku, and listen for Rokus coming and
+       # going unless the user turns it off.
+       rokucore.start_monitor()
+       gobject.timeout_add( 1000, self.update_online )
+       self.item_factory.get_widget( "/View/Watch Network" ).set_active( True )
  
        # Register the delete event so the main window can close.
        self.main_window.connect( "delete_event", self.terminate )
        self.main_window.connect( "destroy", self.terminate )
+
+       # Arrow keys work like the D-pad, and nothing stays held on the Roku
+       # once the window can no longer see the key come up.
+       self.main_window.connect( "key-press-event", rokulib.arrow_pressed )
+       self.main_window.connect( "key-release-event", rokulib.arrow_released )
+       self.main_window.connect( "focus-out-event", rokulib.release_keys )
  
        # Show the main window.
        self.pane.show()
@@ -166,7 +181,12 @@ class App( object ):
        self.menu_items = (
            ( "/File/Find _Devices", "<control>D", self.menu_d_action, 0, None ),
            ( "/File/_Launchers"   , "<control>L", self.menu_l_action, 0, None ),
+           ( "/File/_Channels"    , "<control>G", self.menu_g_action, 0, None ),
+           ( "/File/Export _Metrics", "<control>M", self.menu_m_action, 0, None ),
            ( "/File/Quit"    , "<control>Q", gtk.main_quit, 0, None ),
+           ( "/View/Latency _Stats", "<control>T", self.menu_s_action, 0, "<CheckItem>" ),
+           ( "/View/Watch Network", None, self.menu_w_action, 0, "<CheckItem>" ),
+           ( "/Macros/_Record"   , "<control>R", self.menu_r_action, 0, "<CheckItem>" ),
        )
  
        self.menu = self.get_main_menu( self.main_window )
@@ -247,6 +267,11 @@ class App( object ):
        entry = gtk.Label("Keyboard Entry:")
        launch = gtk.Label("Quick Launch Controls")
 
+       # Whether the selected Roku is up, as far as the listener knows.
+       self.online_label = gtk.Label("")
+       self.pane.put( self.online_label, 470, 25 )
+       self.online_label.show()
+
        self.pane.put( menu,   5, 100 )
        self.pane.put( dpad, 400, 100 )
        self.pane.put( play, 400, 260 )
@@ -279,6 +304,75 @@ class App( object ):
                # If launchers are not defined, they will give attribute errors.
                pass
 
+   def layout_stats(self):
+       """
+       Adds the latency status area below the controls.
+       """
+
+       self.stats_label = gtk.Label("")
+       self.stats_label.set_alignment( 0, 0.5 )
+       self.stats_label.set_ellipsize( pango.ELLIPSIZE_END )
+       self.stats_label.set_size_request( 575, 20 )
+       self.pane.put( self.stats_label, 5, 325 )
+       self.stats_timer = None
+
+
+   def update_stats(self):
+       """
+       Refreshes the latency status area. Runs once a second while shown.
+       """
+
+       device = rokucore.roku_addr.rstrip('/')
+       parts = []
+       errors = 0
+       timeouts = 0
+       for row in rokucore.stats.summary( device ):
+           errors   += row['errors']
+           timeouts += row['timeouts']
+           if row['p50'] is None:
+               continue
+           parts.append( "%s %d/%d/%d" % ( row['endpoint'], row['p50'] * 1000,
+                                           row['p95'] * 1000, row['p99'] * 1000 ))
+
+       if parts:
+           text = "p50/p95/p99 ms: " + "  ".join(parts)
+       else:
+           text = "No requests yet."
+
+       # With mirrors, how far apart commands reached the boxes comes first
+       # so it isn't the part cut off.
+       if rokucore.mirror_urls and rokucore.fanout:
+           last, mean, worst = rokucore.fanout.skew_stats()
+           text = "skew last/avg/max ms: %d/%d/%d  %s" % ( last * 1000, mean * 1000,
+                                                           worst * 1000, text )
+       text += "  errors %d  timeouts %d" % (errors, timeouts)
+       self.stats_label.set_text( text )
+       return True
+
+
+   def update_online(self):
+       """
+       Refreshes the device state indicator. Runs once a second. While the
+       selected Roku is down its buttons are greyed out, since commands to
+       it fail straight away.
+       """
+
+       down = rokucore.is_down()
+       for each in self.buttons:
+           self.buttons[each].set_sensitive( not down )
+
+       listener = rokucore.listener
+       if down:
+           self.online_label.set_markup( '<span foreground="red">Unreachable</span>' )
+       elif not listener or not rokucore.roku_addr:
+           self.online_label.set_text( "" )
+       elif listener.is_online( rokucore.roku_addr ):
+           self.online_label.set_text( "Online" )
+       else:
+           self.online_label.set_text( "Not seen" )
+       return True
+
+
    def fill_libvars(self):
        """
        Fill the library variables.
@@ -313,32 +407,25 @@ class App( object ):
            else:
               rokulib.launchers = {}
   
-           if op.isfile(self.device_file):
-  
-              dev_file    = open( self.device_file, 'r' )
-              device_info = list( yaml.load_all( dev_file ))
-              dev_file.close()
-  
-              if len(device_info) == 2:
-                   roku_address = device_info[0]
-                   roku_name    = device_info[1]
-              else:
-                   roku_address = ""
-                   roku_name    = "NONE SELECTED"
-           else:
-               roku_address = ""
-               roku_name    = "NONE SELECTED"
+           roku_address, roku_name = rokucore.read_device_file( self.device_file )
+           if not roku_address:
+               roku_name = "NONE SELECTED"
   
            if op.isfile(self.icon_file):
                self.main_window.set_icon_from_file( self.icon_file )
   
 
        # Set the roku_addr for the registration function.
-       rokulib.roku_addr = roku_address
+       rokucore.select_device( roku_address, roku_name )
+       rokucore.use_config( self.config_files )
        old_title = self.main_window.get_title()
        self.main_window.set_title( old_title + ': %s' % roku_name )
+
+       # Start from the cached catalog so the window isn't held up by a slow
+       # or sleeping Roku, then pick up any changes in the background.
        if roku_address:
-           rokulib.channels = rokulib.get_channels()
+           rokucore.load_channels( roku_address )
+           rokucore.refresh_channels( rokulib.rebind_launchers )
 
 
    def menu_d_action( self, action, widget ):
@@ -355,6 +442,65 @@ class App( object ):
 
        rokulib.choose_launchers( self.main_window, self.config_files )
 
+   def menu_g_action( self, action, widget ):
+       """
+       Shows the grid of installed channels from the 'File' menu.
+       """
+
+       rokulib.show_channels( self.main_window )
+
+   def menu_m_action( self, action, widget ):
+       """
+       Writes the request latency metrics to the config directory.
+       """
+
+       metrics_file = op.join( self.config_path, 'metrics.txt' )
+       try:
+           out_file = open( metrics_file, 'w' )
+       except IOError:
+           sys.stderr.write( "Could not open %s for writing!\n" % metrics_file )
+           return
+
+       out_file.write( rokucore.stats.metrics_text() )
+       out_file.close()
+       if sys.stdout:
+           sys.stdout.write( "Metrics written to %s\n" % metrics_file )
+
+   def menu_s_action( self, action, widget ):
+       """
+       Shows or hides the latency status area from the 'View' menu.
+       """
+
+       if widget.get_active():
+           self.main_window.set_size_request( 585, 350 )
+           self.update_stats()
+           self.stats_label.show()
+           self.stats_timer = gobject.timeout_add( 1000, self.update_stats )
+       else:
+           if self.stats_timer:
+               gobject.source_remove( self.stats_timer )
+               self.stats_timer = None
+           self.stats_label.hide()
+           self.main_window.set_size_request( 585, 330 )
+
+   def menu_w_action( self, action, widget ):
+       """
+       Starts or stops watching the network for Rokus from the 'View' menu.
+       """
+
+       if widget.get_active():
+           rokucore.start_listener()
+       else:
+           rokucore.stop_listener()
+       self.update_online()
+
+   def menu_r_action( self, action, widget ):
+       """
+       Starts or stops recording a macro from the 'Macros' menu.
+       """
+
+       rokulib.record_macro( self.main_window, widget.get_active() )
+
 def ctrl_c( context, signo ):
    if sys.stdout:
        sys.stdout.write("\b\b")
@@ -35,7 +35,7 @@
 import pygtk
 pygtk.require('2.0')
 import gtk
-from rokulib import keypress, launch
+from rokulib import keypress, hold, launch, macro
 
 
 class RCButton( gtk.Button):
@@ -65,13 +65,21 @@ class RCButton( gtk.Button):
        command  = string[0].lower()
        argument = " ".join( string[1:] )
 
-       # Keypress commands should be in format 'keypress button'
+       # Keypress commands should be in format 'keypress button'. The key is
+       # held on the Roku while the button is held; activating the button
+       # from the keyboard still sends a single press.
        if command == "keypress":
-           self.connect( "clicked", keypress( argument ))
+           pressed, released = hold( argument )
+           self.connect( "pressed", pressed )
+           self.connect( "released", released )
+           self.connect( "activate", keypress( argument ))
 
        elif command == "launch":
            self.handler = self.connect( "clicked", launch( argument ))
 
+       elif command == "macro":
+           self.handler = self.connect( "clicked", macro( argument ))
+
        else:
            error = '"%s" is not a valid command.' % command
            raise SyntaxError, error
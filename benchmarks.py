@@ -0,0 +1,449 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: benchmarks.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: Timing runs for the hot paths of the remote. Results are printed
+#           as JSON so they can be kept and compared between releases.
+#
+################################################################################
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import ecpxml
+import rokucore
+from mockroku import make_catalog, Behavior, MockNetwork
+
+# Catalog sizes to parse.
+CATALOG_SIZES = [50, 500, 5000]
+
+# Number of simulated Rokus answering a search.
+RESPONDER_COUNTS = [1, 10, 200]
+
+# Text typed for the text entry benchmark, the drop rates to type it at and
+# the smallest gap between keys the simulated box will accept.
+SAMPLE_TEXT = "the quick brown fox jumps over the lazy dog"
+DROP_RATES  = [0.0, 0.05]
+KEY_GAP     = 0.05
+
+# Keys per batch when the same text is pipelined without pacing.
+TEXT_BATCH = 10
+
+# Key presses per burst and the batch sizes to pipeline them in. A batch of
+# one is the plain requests path.
+BURST_KEYS    = 200
+BATCH_SIZES   = [1, 10, 50]
+BUSY_KEY_GAP  = 0.05
+
+# Mirrored Rokus and key presses sent to them for the fan-out benchmark.
+FANOUT_DEVICES = 4
+FANOUT_KEYS    = 50
+
+# Channel icons loaded per pass, as if a grid of them were scrolled through,
+# and the round-trip latency of the simulated Roku serving them.
+ICON_COUNT   = 60
+ICON_LATENCY = 0.02
+
+
+def regex_channels( document ):
+   """
+   The line-by-line parser get_channels() used before ecpxml, kept here as a
+   baseline.
+   """
+   channels = {}
+   for channel in document.splitlines():
+       app_id = re.search(r'<app id=("\d+?")', channel)
+       name   = re.search(r'>([A-Za-z0-9\s\.\-]+?)</app>', channel)
+       if app_id and name:
+           channels[name.group(1)] = app_id.group(1)
+   return channels
+
+
+def chunks( document, size=8192 ):
+   """
+   Splits a document the way a streamed response would arrive.
+   """
+   return [ document[start:start + size] for start in range(0, len(document), size) ]
+
+
+def best_of( func, repeat=5 ):
+   """
+   Returns the fastest of several runs, in seconds, and the last result.
+   """
+   best = None
+   for count in range(0, repeat):
+       start = time.time()
+       result = func()
+       elapsed = time.time() - start
+       if best is None or elapsed < best:
+           best = elapsed
+   return best, result
+
+
+def bench_catalog_parsing( sizes=CATALOG_SIZES ):
+   """
+   Times ecpxml.parse_channels() against the old regex parser.
+   """
+   results = []
+   for size in sizes:
+       document = make_catalog( size )
+       parts = chunks( document )
+
+       xml_time, catalog  = best_of( lambda: ecpxml.parse_channels( parts ) )
+       re_time,  baseline = best_of( lambda: regex_channels( document ) )
+
+       results.append( {
+           'benchmark'       : 'catalog_parsing',
+           'apps'            : size,
+           'bytes'           : len(document),
+           'seconds'         : xml_time,
+           'apps_per_second' : size / xml_time,
+           'apps_parsed'     : len(catalog),
+           'regex_seconds'   : re_time,
+           'regex_parsed'    : len(baseline),
+       } )
+   return results
+
+
+def bench_catalog_fetch( sizes=CATALOG_SIZES ):
+   """
+   Times get_channels() end to end against a simulated Roku.
+   """
+   results = []
+   for size in sizes:
+       network = MockNetwork( 1, apps=size ).start()
+       try:
+           rokucore.select_device( network.devices[0].url )
+           elapsed, catalog = best_of( rokucore.get_channels )
+       finally:
+           network.stop()
+
+       results.append( {
+           'benchmark'       : 'catalog_fetch',
+           'apps'            : size,
+           'seconds'         : elapsed,
+           'apps_per_second' : size / elapsed,
+           'apps_parsed'     : len(catalog),
+       } )
+   return results
+
+
+def bench_dial_data( repeat=50 ):
+   """
+   Times Roku.get_dial_data() over a warm connection.
+   """
+   network = MockNetwork( 1 ).start()
+   try:
+       roku = rokucore.Roku( network.devices[0].url )
+       roku.get_dial_data()
+       start = time.time()
+       for count in range(0, repeat):
+           roku.get_dial_data()
+       elapsed = time.time() - start
+   finally:
+       network.stop()
+
+   return [ {
+       'benchmark'        : 'dial_data',
+       'calls'            : repeat,
+       'seconds_per_call' : elapsed / repeat,
+       'model_name'       : roku.model_name,
+   } ]
+
+
+def bench_discovery( counts=RESPONDER_COUNTS, loss=0.0 ):
+   """
+   Times find_rokus() against a number of simulated responders, once ending
+   on a quiet period and once expecting the devices it should find.
+   """
+   results = []
+   for count in counts:
+       for expecting in (False, True):
+           network = MockNetwork( count, Behavior(latency=0.005, jitter=0.02, loss=loss) ).start()
+           try:
+               expect = None
+               if expecting:
+                   expect = set( device.usn for device in network.devices )
+               start = time.time()
+               devices = rokucore.find_rokus( 'lo', target=('127.0.0.1', network.ssdp_port),
+                                              expect=expect )
+               elapsed = time.time() - start
+           finally:
+               network.stop()
+
+           results.append( {
+               'benchmark'  : 'discovery',
+               'responders' : count,
+               'expecting'  : expecting,
+               'loss'       : loss,
+               'found'      : len(devices),
+               'seconds'    : elapsed,
+           } )
+   return results
+
+
+def bench_text_entry( drop_rates=DROP_RATES, key_gap=KEY_GAP, text=SAMPLE_TEXT ):
+   """
+   Measures send_text() throughput, in characters per second, against a
+   simulated Roku that drops some of the keys. 'exact' says whether the text
+   arrived intact; a dropped key gives the sender no signal, so anything but
+   a zero drop rate is expected to lose characters. Each case is also typed
+   as unpaced pipelined batches of TEXT_BATCH keys, to show what a busy box
+   makes of those.
+   """
+   results = []
+   keys = [ 'Lit_' + ('%20' if letter == ' ' else letter) for letter in text ]
+   for drop_rate in drop_rates:
+       for batch in (1, TEXT_BATCH):
+           behavior = Behavior( latency=0.002, jitter=0.004, drop_rate=drop_rate, key_gap=key_gap )
+           network = MockNetwork( 1, behavior ).start()
+           try:
+               device = network.devices[0]
+               client = rokucore.get_client( device.url )
+               pacer  = rokucore.Pacer()
+               start  = time.time()
+               if batch == 1:
+                   rokucore.type_text( client, text, pacer )
+               else:
+                   rokucore.send_keys( client, keys, None, batch )
+               elapsed = time.time() - start
+           finally:
+               network.stop()
+
+           results.append( {
+               'benchmark'        : 'text_entry',
+               'drop_rate'        : drop_rate,
+               'key_gap'          : key_gap,
+               'batch'            : batch,
+               'paced'            : batch == 1,
+               'characters'       : len(text),
+               'seconds'          : elapsed,
+               'chars_per_second' : len(text) / elapsed,
+               'delivered'        : len(device.keys),
+               'dropped'          : len(device.dropped),
+               'exact'            : device.typed() == text,
+               'final_delay'      : pacer.delay,
+           } )
+   return results
+
+
+def bench_pipelining( batches=BATCH_SIZES, keys=BURST_KEYS ):
+   """
+   Times a burst of key presses sent one request at a time through requests
+   against the same burst pipelined in batches, on a device that keeps
+   connections alive, on one that closes them after every reply and on a
+   busy one that ignores keys closer together than BUSY_KEY_GAP. 'delivered'
+   shows how much of an unpaced burst the busy box actually took.
+   """
+   results = []
+   paths = [ '/keypress/Lit_%s' % chr(ord('a') + count % 26) for count in range(0, keys) ]
+
+   for keepalive, key_gap in ((True, 0.0), (False, 0.0), (True, BUSY_KEY_GAP)):
+       for batch in batches:
+           behavior = Behavior( latency=0.001, keepalive=keepalive, key_gap=key_gap )
+           network = MockNetwork( 1, behavior ).start()
+           try:
+               device = network.devices[0]
+               client = rokucore.EcpClient( device.url )
+               client.post( '/keypress/Home' )
+               device.reset()
+
+               start = time.time()
+               if batch == 1:
+                   for path in paths:
+                       client.post( path )
+               else:
+                   for first in range(0, len(paths), batch):
+                       client.post_many( paths[first:first + batch] )
+               elapsed = time.time() - start
+               client.close()
+           finally:
+               network.stop()
+
+           results.append( {
+               'benchmark'           : 'pipelining',
+               'keepalive'           : keepalive,
+               'key_gap'             : key_gap,
+               'batch'               : batch,
+               'requests'            : keys,
+               'seconds'             : elapsed,
+               'requests_per_second' : keys / elapsed,
+               'delivered'           : len(device.keys),
+               'pipelined'           : client.pipeline is not None and batch > 1,
+           } )
+   return results
+
+
+def bench_fanout( count=FANOUT_DEVICES, keys=FANOUT_KEYS ):
+   """
+   Measures the skew of mirrored key presses, how far apart they reached the
+   devices, through a Fanout and through the same clients one after the
+   other. A parallel fan-out keeps it near the spread in latency.
+   """
+   results = []
+   network = MockNetwork( count, Behavior(latency=0.01, jitter=0.005) ).start()
+   try:
+       urls = [ device.url for device in network.devices ]
+       for mode in ('fanout', 'sequential'):
+           skews = []
+           start = time.time()
+           if mode == 'fanout':
+               target = rokucore.Fanout( urls )
+               for press in range(0, keys):
+                   skews.append( target.keypress('Home') )
+               target.close()
+           else:
+               clients = [ rokucore.get_client(url) for url in urls ]
+               for press in range(0, keys):
+                   arrivals = []
+                   for client in clients:
+                       sent = time.time()
+                       client.keypress( 'Home' )
+                       arrivals.append( sent + (time.time() - sent) / 2 )
+                   skews.append( max(arrivals) - min(arrivals) )
+           elapsed = time.time() - start
+
+           results.append( {
+               'benchmark'  : 'fanout',
+               'mode'       : mode,
+               'devices'    : len(urls),
+               'keys'       : keys,
+               'seconds'    : elapsed,
+               'mean_skew'  : sum(skews) / len(skews),
+               'worst_skew' : max(skews),
+           } )
+   finally:
+       network.stop()
+   return results
+
+
+def bench_icons( count=ICON_COUNT, latency=ICON_LATENCY ):
+   """
+   Times loading a grid's worth of channel icons through the icon cache:
+   from the Roku, from memory and, with a fresh cache, from disk.
+   """
+   results = []
+   directory = tempfile.mkdtemp()
+   network = MockNetwork( 1, Behavior(latency=latency), apps=count ).start()
+   try:
+       client = rokucore.EcpClient( network.devices[0].url )
+       versions = {}
+       ecpxml.parse_channels( client.get('/query/apps').content, versions )
+
+       cache = rokucore.IconCache( directory )
+       for source in ('network', 'memory', 'disk'):
+           if source == 'disk':
+               cache = rokucore.IconCache( directory )
+
+           misses = cache.misses
+           start = time.time()
+           for app_id in sorted( versions ):
+               cache.fetch( app_id, versions[app_id], client )
+           elapsed = time.time() - start
+
+           results.append( {
+               'benchmark'        : 'icons',
+               'source'           : source,
+               'icons'            : len(versions),
+               'seconds'          : elapsed,
+               'icons_per_second' : len(versions) / elapsed,
+               'fetched'          : cache.misses - misses,
+           } )
+       client.close()
+   finally:
+       network.stop()
+       shutil.rmtree( directory )
+   return results
+
+
+# Every benchmark, by the name used on the command line.
+BENCHMARKS = [
+   ('catalog_parsing', bench_catalog_parsing),
+   ('catalog_fetch',   bench_catalog_fetch),
+   ('dial_data',       bench_dial_data),
+   ('discovery',       bench_discovery),
+   ('text_entry',      bench_text_entry),
+   ('pipelining',      bench_pipelining),
+   ('fanout',          bench_fanout),
+   ('icons',           bench_icons),
+]
+
+
+def main( argv ):
+   """
+   Runs the benchmarks and prints the results.
+   """
+   names = [ name for name, bench in BENCHMARKS ]
+   parser = argparse.ArgumentParser( description="Benchmark the remote against simulated Rokus." )
+   parser.add_argument( 'only', nargs='*', choices=names + [[]], metavar='BENCHMARK',
+                        help="benchmarks to run (default: all of %s)" % ", ".join(names) )
+   parser.add_argument( '-o', '--output', help="write the results to a file" )
+   parser.add_argument( '--drop-rate', type=float, action='append',
+                        help="drop rate for text entry, may be repeated (default: %s)" % DROP_RATES )
+   parser.add_argument( '--loss', type=float, default=0.0,
+                        help="chance a simulated Roku ignores a search or request (default: %(default)s)" )
+   parser.add_argument( '--key-gap', type=float, default=KEY_GAP,
+                        help="seconds the simulated box needs between keys (default: %(default)s)" )
+   args = parser.parse_args( argv )
+
+   results = []
+   for name, bench in BENCHMARKS:
+       if args.only and name not in args.only:
+           continue
+       if name == 'text_entry':
+           results.extend( bench( args.drop_rate or DROP_RATES, args.key_gap ) )
+       elif name == 'discovery':
+           results.extend( bench( loss=args.loss ) )
+       else:
+           results.extend( bench() )
+
+   report = {
+       'python'  : platform.python_version(),
+       'time'    : time.time(),
+       'results' : results,
+   }
+
+   output = open( args.output, 'w' ) if args.output else sys.stdout
+   json.dump( report, output, indent=2, sort_keys=True )
+   output.write( '\n' )
+   if args.output:
+       output.close()
+
+
+#
+# Invocation Check:
+#
+if __name__ == "__main__":
+   main( sys.argv[1:] )
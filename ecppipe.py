@@ -0,0 +1,207 @@
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: ecppipe.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: A bare HTTP/1.1 connection for sending bursts of ECP commands.
+#           Every request in a batch is written before any reply is read,
+#           so a burst costs one round trip instead of one per command.
+#
+################################################################################
+import time
+import socket
+import urlparse
+
+# Bytes read from the socket at a time.
+CHUNK_SIZE = 4096
+
+
+class PipelineError(IOError):
+   """
+   Raised when a batch could not be finished. 'done' holds the replies that
+   did arrive, so the caller knows which requests were answered. 'unsent'
+   is True when the rest are known not to have been carried out, because
+   the device closed the connection before answering anything or said it
+   would close after the last reply; only then are they safe to send again.
+   """
+
+
+   def __init__(self, message, done=None, unsent=False):
+       IOError.__init__(self, message)
+       self.done   = done or []
+       self.unsent = unsent
+
+
+class PipelinedConnection(object):
+   """
+   Class to hold one raw keep-alive connection to a device. Requests carry
+   no body and only the status of each reply is kept, which is all ECP
+   commands need.
+   """
+
+
+   def __init__(self, url, timeout=5.0):
+       parts = urlparse.urlsplit( url )
+       self.host    = parts.hostname
+       self.port    = parts.port or 80
+       self.prefix  = parts.path.rstrip('/')
+       self.timeout = timeout
+
+       self.sock     = None
+       self.buffer   = ''
+       self.closing  = False
+       self.received = 0
+
+
+   def connect(self):
+       """
+       Opens the connection.
+       """
+       self.sock = socket.create_connection( (self.host, self.port), self.timeout )
+       self.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+       self.buffer  = ''
+       self.closing = False
+
+
+   def close(self):
+       """
+       Closes the connection. The next batch opens a new one.
+       """
+       if self.sock:
+           self.sock.close()
+       self.sock = None
+
+
+   def is_open(self):
+       return self.sock is not None
+
+
+   def send_batch(self, paths, method='POST'):
+       """
+       Sends a request for every path, then reads the replies in order.
+       Returns a (status, seconds) pair per request. The device works through
+       a pipelined batch one request at a time, so the time is from the reply
+       before it (or the write, for the first) until that reply came in.
+       """
+       host  = "%s:%d" % (self.host, self.port)
+       batch = [ "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: 0\r\n\r\n"
+                 % (method, self.prefix + path, host) for path in paths ]
+
+       done = []
+       self.received = 0
+       try:
+           if not self.sock:
+               self.connect()
+           self.sock.sendall( ''.join(batch) )
+           last = time.time()
+           for path in paths:
+               if self.closing:
+                   raise PipelineError( "device closed the connection after %d replies" % len(done) )
+               status = self.read_response()
+               now = time.time()
+               done.append( (status, now - last) )
+               last = now
+       except (socket.error, PipelineError) as err:
+           # A timeout says nothing about what the device did, but a close
+           # with nothing read, or after the device said it would, does.
+           unsent = self.closing or (self.received == 0 and not isinstance(err, socket.timeout))
+           self.close()
+           raise PipelineError( str(err), done, unsent )
+
+       if self.closing:
+           self.close()
+       return done
+
+
+   def fill(self):
+       """
+       Reads more from the socket into the buffer.
+       """
+       data = self.sock.recv( CHUNK_SIZE )
+       if not data:
+           raise PipelineError( "connection closed by device" )
+       self.received += len(data)
+       self.buffer += data
+
+
+   def read_line(self):
+       while '\r\n' not in self.buffer:
+           self.fill()
+       line, self.buffer = self.buffer.split('\r\n', 1)
+       return line
+
+
+   def read_bytes(self, size):
+       while len(self.buffer) < size:
+           self.fill()
+       data, self.buffer = self.buffer[:size], self.buffer[size:]
+       return data
+
+
+   def read_response(self):
+       """
+       Reads one reply and returns its status code. The body is skipped, as
+       are interim 1xx replies.
+       """
+       while True:
+           status = self.read_line().split(None, 2)
+           if len(status) < 2 or not status[0].startswith('HTTP/1.') or not status[1].isdigit():
+               raise PipelineError( "bad status line %r" % ' '.join(status) )
+
+           headers = {}
+           while True:
+               line = self.read_line()
+               if not line:
+                   break
+               name, _, value = line.partition(':')
+               headers[name.strip().lower()] = value.strip().lower()
+
+           code = int( status[1] )
+           if not 100 <= code < 200:
+               break
+
+       if headers.get('connection') == 'close' or status[0] == 'HTTP/1.0':
+           self.closing = True
+
+       if code in (204, 304):
+           # These never have a body, whatever the headers say.
+           pass
+       elif headers.get('transfer-encoding') == 'chunked':
+           while True:
+               size = int( self.read_line().split(';')[0], 16 )
+               self.read_bytes( size + 2 )
+               if size == 0:
+                   break
+       elif 'content-length' in headers:
+           self.read_bytes( int(headers['content-length']) )
+       else:
+           # Without a length the body runs to the end of the connection,
+           # which can't be told apart from the next reply.
+           raise PipelineError( "reply without a length" )
+
+       return code
@@ -0,0 +1,139 @@
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: ecpxml.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: Single pass parsers for the XML documents the Roku serves:
+#           the channel list from /query/apps and the device description
+#           from dial/dd.xml (or /query/device-info).
+#
+################################################################################
+from collections import namedtuple
+
+try:
+   import xml.etree.cElementTree as ElementTree
+except ImportError:
+   import xml.etree.ElementTree as ElementTree
+
+# One installed channel from /query/apps.
+Channel = namedtuple('Channel', 'app_id name version type')
+
+# Elements of interest in dial/dd.xml and /query/device-info.
+DEVICE_FIELDS = frozenset([
+   'friendlyName', 'modelName', 'modelNumber', 'serialNumber', 'UDN',
+   'friendly-device-name', 'model-name', 'model-number', 'serial-number',
+   'udn',
+])
+
+
+class ChunkReader(object):
+   """
+   Class to present an iterable of byte strings (like a response's
+   iter_content()) as a file so it can be fed to the parser as it arrives.
+   """
+
+
+   def __init__(self, chunks):
+       self.chunks = iter(chunks)
+       self.buffer = ''
+
+
+   def read(self, size=-1):
+       while size < 0 or len(self.buffer) < size:
+           try:
+               self.buffer += next(self.chunks)
+           except StopIteration:
+               break
+
+       if size < 0:
+           size = len(self.buffer)
+       data, self.buffer = self.buffer[:size], self.buffer[size:]
+       return data
+
+
+def as_file( source ):
+   """
+   Accepts a file-like object, an iterable of chunks or a whole document.
+   """
+   if hasattr( source, 'read' ):
+       return source
+   if isinstance( source, basestring ):
+       return ChunkReader( [source] )
+   return ChunkReader( source )
+
+
+def local_name( tag ):
+   """
+   Strips the namespace from an element tag. dd.xml puts everything in the
+   UPnP device namespace.
+   """
+   return tag.rsplit('}', 1)[-1]
+
+
+def iter_channels( source ):
+   """
+   Yields a Channel for each <app> element, clearing elements as it goes so
+   memory use does not grow with the size of the catalog.
+   """
+   for event, elem in ElementTree.iterparse( as_file(source) ):
+       if local_name( elem.tag ) != 'app':
+           continue
+
+       yield Channel( elem.get('id'), (elem.text or '').strip(),
+                      elem.get('version'), elem.get('type') )
+       elem.clear()
+
+
+def parse_channels( source, versions=None ):
+   """
+   Returns the catalog as a dictionary of channel name to application id.
+   If a versions dictionary is given, each channel's version is stored in
+   it by application id.
+   """
+   catalog = {}
+   for channel in iter_channels( source ):
+       if channel.app_id and channel.name:
+           catalog[channel.name] = channel.app_id
+           if versions is not None:
+               versions[channel.app_id] = channel.version
+   return catalog
+
+
+def parse_device_info( source ):
+   """
+   Returns a dictionary of the device fields found, keyed by element name.
+   Only the first occurrence of each is kept; in dd.xml that belongs to the
+   root device.
+   """
+   info = {}
+   for event, elem in ElementTree.iterparse( as_file(source) ):
+       name = local_name( elem.tag )
+       if name in DEVICE_FIELDS and name not in info:
+           info[name] = (elem.text or '').strip()
+       elem.clear()
+   return info
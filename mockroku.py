@@ -0,0 +1,496 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: mockroku.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: Stand-in Rokus for testing and benchmarking without hardware.
+#           Answers SSDP M-SEARCH for roku:ecp and serves dial/dd.xml,
+#           /query/apps, /query/device-info, /keypress, /launch and friends,
+#           with adjustable latency, jitter, loss and dropped keys. Any
+#           number of virtual devices can run at once.
+#
+################################################################################
+import re
+import sys
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+MULTICAST_ADDR = '239.255.255.250'
+
+# A 1x1 transparent PNG, standing in for channel artwork.
+ICON_PNG = ( '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01'
+             '\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8'
+             '\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82' )
+
+# Port the SSDP responder listens on by default. Not 1900, so a simulator and
+# a real search on the same machine don't fight over it.
+SSDP_PORT = 1901
+
+
+def make_catalog( size ):
+   """
+   Builds a /query/apps document with the given number of channels. Some
+   names use characters that need escaping.
+   """
+   names = [ "Channel %d", "Tom & Jerry's %d", "Caf\xc3\xa9 %d", "News-%d" ]
+   lines = [ '<?xml version="1.0" encoding="UTF-8" ?>', '<apps>' ]
+   for count in range(0, size):
+       name = names[count % len(names)] % count
+       name = name.replace('&', '&amp;').replace("'", '&apos;')
+       lines.append( '   <app id="%d" type="appl" version="1.0.%d">%s</app>'
+                     % (10000 + count, count, name) )
+   lines.append( '</apps>' )
+   return '\n'.join(lines) + '\n'
+
+
+class Behavior(object):
+   """
+   Class to hold how badly a virtual device behaves. Times are in seconds.
+
+   latency   - added before every reply (HTTP and SSDP)
+   jitter    - up to this much more, picked at random per reply
+   loss      - chance a request gets no reply at all
+   drop_rate - chance a key press is answered but ignored
+   key_gap   - key presses closer together than this are answered but
+               ignored, like a real box that is busy
+   keepalive - if False, every reply closes the connection, like a device
+               that can't take pipelined requests
+   """
+
+
+   def __init__(self, latency=0.0, jitter=0.0, loss=0.0, drop_rate=0.0, key_gap=0.0,
+                keepalive=True):
+       self.latency   = latency
+       self.jitter    = jitter
+       self.loss      = loss
+       self.drop_rate = drop_rate
+       self.key_gap   = key_gap
+       self.keepalive = keepalive
+
+
+   def delay(self):
+       """
+       Sleeps for one reply's worth of latency.
+       """
+       wait = self.latency + random.uniform( 0, self.jitter )
+       if wait > 0:
+           time.sleep( wait )
+
+
+   def lost(self):
+       return self.loss > 0 and random.random() < self.loss
+
+
+class VirtualRoku(object):
+   """
+   Class for one simulated device: its identity, channels and everything it
+   has been asked to do.
+   """
+
+   DD_XML = '''<?xml version="1.0" encoding="UTF-8" ?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:roku-com:device:player:1-0</deviceType>
+    <friendlyName>%(name)s</friendlyName>
+    <manufacturer>Roku</manufacturer>
+    <modelName>%(model_name)s</modelName>
+    <modelNumber>%(model_number)s</modelNumber>
+    <serialNumber>%(serial)s</serialNumber>
+    <UDN>uuid:%(serial)s</UDN>
+  </device>
+</root>
+'''
+
+   DEVICE_INFO = '''<?xml version="1.0" encoding="UTF-8" ?>
+<device-info>
+  <udn>uuid:%(serial)s</udn>
+  <serial-number>%(serial)s</serial-number>
+  <model-name>%(model_name)s</model-name>
+  <model-number>%(model_number)s</model-number>
+  <friendly-device-name>%(name)s</friendly-device-name>
+</device-info>
+'''
+
+
+   def __init__(self, index, behavior=None, apps=20, model_number='4200X'):
+       self.index    = index
+       self.behavior = behavior or Behavior()
+       self.fields   = { 'name'         : 'Mock Roku %d' % index,
+                         'model_name'   : 'Roku 3',
+                         'model_number' : model_number,
+                         'serial'       : 'MOCK%08d' % index }
+       self.catalog  = make_catalog( apps )
+       self.server   = None
+       self.lock     = threading.Lock()
+
+       # What the device was told to do, with when it was told.
+       self.keys     = []
+       self.dropped  = []
+       self.launches = []
+       self.requests = 0
+       self.last_key = 0
+
+
+   @property
+   def usn(self):
+       return 'uuid:roku:ecp:%s' % self.fields['serial']
+
+
+   @property
+   def url(self):
+       return 'http://%s:%d/' % self.server.server_address
+
+
+   def press(self, key):
+       """
+       Records a key press, unless the device 'misses' it.
+       """
+       now = time.time()
+       with self.lock:
+           busy = now - self.last_key < self.behavior.key_gap
+           self.last_key = now
+           if busy or random.random() < self.behavior.drop_rate:
+               self.dropped.append( (now, key) )
+           else:
+               self.keys.append( (now, key) )
+
+
+   def typed(self):
+       """
+       Returns the text the device received through Lit_ key presses.
+       """
+       with self.lock:
+           letters = [ key[4:] for when, key in self.keys if key.startswith('Lit_') ]
+       return ''.join(letters).replace('%20', ' ')
+
+
+   def reset(self):
+       """
+       Forgets every command received so far.
+       """
+       with self.lock:
+           self.keys, self.dropped, self.launches = [], [], []
+           self.requests = 0
+
+
+class EcpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """
+   Serves the ECP endpoints for the VirtualRoku attached to the server.
+   """
+
+   protocol_version = 'HTTP/1.1'
+
+   # Buffer the reply and send it in one go; an unbuffered reply is written a
+   # header at a time and trips over Nagle and delayed ACKs.
+   wbufsize = -1
+
+
+   def setup(self):
+       BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+       self.connection.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+
+   def reply(self, code, body='', content_type='text/xml; charset="utf-8"'):
+       self.send_response( code )
+       self.send_header( 'Content-Type', content_type )
+       self.send_header( 'Content-Length', str(len(body)) )
+       if not self.server.device.behavior.keepalive:
+           self.send_header( 'Connection', 'close' )
+           self.close_connection = 1
+       self.end_headers()
+       self.wfile.write( body )
+
+
+   def serve(self):
+       device = self.server.device
+       with device.lock:
+           device.requests += 1
+
+       if device.behavior.lost():
+           # Say nothing and hang up, as if the packets never made it.
+           self.close_connection = 1
+           return
+
+       device.behavior.delay()
+
+       # Drain a body if the client sent one.
+       length = int( self.headers.getheader('Content-Length') or 0 )
+       if length:
+           self.rfile.read( length )
+
+       path = self.path.split('?')[0]
+       match = re.match( r'^/(keypress|keydown|keyup|launch|query/icon)/(.+)$', path )
+
+       if self.command == 'GET' and path == '/dial/dd.xml':
+           return self.reply( 200, VirtualRoku.DD_XML % device.fields )
+       if self.command == 'GET' and path == '/query/device-info':
+           return self.reply( 200, VirtualRoku.DEVICE_INFO % device.fields )
+       if self.command == 'GET' and path == '/query/apps':
+           return self.reply( 200, device.catalog )
+       if self.command == 'GET' and path == '/':
+           return self.reply( 200, VirtualRoku.DD_XML % device.fields )
+
+       if match and self.command == 'POST':
+           action, argument = match.groups()
+           if action == 'keypress':
+               device.press( argument )
+           elif action == 'keydown':
+               # Held keys count once; the box does its own auto-repeat.
+               device.press( argument )
+           elif action == 'launch':
+               with device.lock:
+                   device.launches.append( (time.time(), argument) )
+           return self.reply( 200 )
+
+       if match and self.command == 'GET' and match.group(1) == 'query/icon':
+           return self.reply( 200, ICON_PNG, 'image/png' )
+
+       self.reply( 404 )
+
+
+   def do_GET(self):
+       self.serve()
+
+
+   def do_POST(self):
+       self.serve()
+
+
+   def log_message(self, format, *args):
+       pass
+
+
+class EcpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+
+   def handle_error(self, request, client_address):
+       # Clients dropping keep-alive connections, or the process exiting
+       # under a handler thread, are business as usual for a simulator.
+       pass
+
+
+class SsdpResponder(object):
+   """
+   Class to answer M-SEARCH requests for every virtual device. It listens on
+   a unicast port and, where the host allows, on the SSDP multicast group.
+   """
+
+
+   def __init__(self, devices, host='127.0.0.1', port=SSDP_PORT, max_age=3600):
+       self.devices = devices
+       self.host    = host
+       self.max_age = max_age
+       self.running = True
+
+       self.sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP )
+       self.sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+       self.sock.bind( ('', port) )
+       self.port = self.sock.getsockname()[1]
+
+       try:
+           membership = struct.pack( '4sl', socket.inet_aton(MULTICAST_ADDR),
+                                     socket.INADDR_ANY )
+           self.sock.setsockopt( socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership )
+       except socket.error:
+           # No multicast route (common in containers). Unicast still works.
+           pass
+
+       self.thread = threading.Thread( target=self.run, name="mock-ssdp" )
+       self.thread.daemon = True
+       self.thread.start()
+
+
+   def reply_for(self, device):
+       return ( 'HTTP/1.1 200 OK\r\n'
+                'CACHE-CONTROL: max-age=%d\r\n' % self.max_age +
+                'ST: roku:ecp\r\n'
+                'LOCATION: %s\r\n' % device.url +
+                'USN: %s\r\n' % device.usn +
+                '\r\n' )
+
+
+   def notify_for(self, device, kind):
+       return ( 'NOTIFY * HTTP/1.1\r\n'
+                'HOST: %s:1900\r\n' % MULTICAST_ADDR +
+                'CACHE-CONTROL: max-age=%d\r\n' % self.max_age +
+                'NT: roku:ecp\r\n'
+                'NTS: %s\r\n' % kind +
+                'LOCATION: %s\r\n' % device.url +
+                'USN: %s\r\n' % device.usn +
+                '\r\n' )
+
+
+   def announce(self, kind='ssdp:alive', target=(MULTICAST_ADDR, 1900)):
+       """
+       Sends a NOTIFY for every device, as real boxes do when they come up
+       (ssdp:alive) or shut down (ssdp:byebye).
+       """
+       for device in self.devices:
+           try:
+               self.sock.sendto( self.notify_for(device, kind), target )
+           except socket.error:
+               pass
+
+
+   def answer(self, device, sender):
+       if device.behavior.lost():
+           return
+       device.behavior.delay()
+       try:
+           self.sock.sendto( self.reply_for(device), sender )
+       except socket.error:
+           pass
+
+
+   def run(self):
+       while self.running:
+           try:
+               data, sender = self.sock.recvfrom( 2048 )
+           except socket.error:
+               return
+
+           if not data.startswith('M-SEARCH'):
+               continue
+           if not re.search( r'^ST:\s*(roku:ecp|ssdp:all)', data, re.IGNORECASE | re.MULTILINE ):
+               continue
+
+           # Each device answers on its own schedule, like real boxes do.
+           for device in self.devices:
+               if device.behavior.latency or device.behavior.jitter:
+                   worker = threading.Thread( target=self.answer, args=(device, sender) )
+                   worker.daemon = True
+                   worker.start()
+               else:
+                   self.answer( device, sender )
+
+
+   def close(self):
+       self.running = False
+       self.sock.close()
+
+
+class MockNetwork(object):
+   """
+   Class to run a group of virtual Rokus and their SSDP responder.
+
+       network = MockNetwork( 10, Behavior(latency=0.02) )
+       network.start()
+       ... find_rokus( 'lo', target=('127.0.0.1', network.ssdp_port) ) ...
+       network.stop()
+   """
+
+
+   def __init__(self, count=1, behavior=None, apps=20, host='127.0.0.1',
+                ssdp_port=0, max_age=3600):
+       self.host      = host
+       self.ssdp_port = ssdp_port
+       self.max_age   = max_age
+       self.devices   = [ VirtualRoku(index, behavior, apps) for index in range(0, count) ]
+       self.responder = None
+
+
+   def start(self):
+       """
+       Starts an ECP server per device (on a free port) and the responder.
+       """
+       for device in self.devices:
+           device.server = EcpServer( (self.host, 0), EcpHandler )
+           device.server.device = device
+           thread = threading.Thread( target=device.server.serve_forever,
+                                      name="mock-ecp-%d" % device.index )
+           thread.daemon = True
+           thread.start()
+
+       self.responder = SsdpResponder( self.devices, self.host, self.ssdp_port, self.max_age )
+       self.ssdp_port = self.responder.port
+       return self
+
+
+   def announce(self, kind='ssdp:alive', target=(MULTICAST_ADDR, 1900)):
+       """
+       Has every device send a NOTIFY. See SsdpResponder.announce().
+       """
+       self.responder.announce( kind, target )
+
+
+   def stop(self):
+       if self.responder:
+           self.responder.close()
+       for device in self.devices:
+           if device.server:
+               device.server.shutdown()
+               device.server.server_close()
+
+
+def main( argv ):
+   parser = argparse.ArgumentParser( description="Run simulated Rokus." )
+   parser.add_argument( '-n', '--count', type=int, default=1, help="number of devices" )
+   parser.add_argument( '-a', '--apps', type=int, default=20, help="channels per device" )
+   parser.add_argument( '--host', default='127.0.0.1', help="address to serve on" )
+   parser.add_argument( '--ssdp-port', type=int, default=SSDP_PORT )
+   parser.add_argument( '--latency', type=float, default=0.0 )
+   parser.add_argument( '--jitter', type=float, default=0.0 )
+   parser.add_argument( '--loss', type=float, default=0.0 )
+   parser.add_argument( '--drop-rate', type=float, default=0.0 )
+   parser.add_argument( '--key-gap', type=float, default=0.0 )
+   parser.add_argument( '--no-keepalive', dest='keepalive', action='store_false',
+                        help="close the connection after every reply" )
+   args = parser.parse_args( argv )
+
+   behavior = Behavior( args.latency, args.jitter, args.loss, args.drop_rate, args.key_gap,
+                        args.keepalive )
+   network = MockNetwork( args.count, behavior, args.apps, args.host, args.ssdp_port ).start()
+
+   sys.stdout.write( "SSDP on %s:%d\n" % (args.host, network.ssdp_port) )
+   for device in network.devices:
+       sys.stdout.write( "%s  %s\n" % (device.url, device.usn) )
+   sys.stdout.flush()
+
+   try:
+       while True:
+           time.sleep( 1 )
+   except KeyboardInterrupt:
+       network.stop()
+   return 0
+
+
+#
+# Invocation Check:
+#
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
@@ -0,0 +1,84 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: rokuc.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: Thin client for rokud.py. Deliberately imports nothing heavy so
+#           a hotkey can fire a command in a few milliseconds.
+#
+#           rokuc.py keypress Home
+#           rokuc.py launch Netflix
+#
+################################################################################
+import os
+import sys
+import socket
+
+SOCKET_FILE = os.path.join(os.path.expanduser('~'), '.roku_remote', 'rokud.sock')
+
+
+def send( line, socket_file=SOCKET_FILE ):
+   """
+   Sends one command line to the daemon and returns its reply line.
+   """
+   sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+   sock.connect( socket_file )
+   sock.sendall( line.strip() + "\n" )
+
+   reply = ''
+   while not reply.endswith("\n"):
+       data = sock.recv(4096)
+       if not data:
+           break
+       reply += data
+
+   sock.close()
+   return reply.strip()
+
+
+def main( argv ):
+   if not argv:
+       sys.stderr.write( "usage: rokuc.py command [argument...]\n" )
+       return 2
+
+   try:
+       reply = send( " ".join(argv) )
+   except socket.error as err:
+       sys.stderr.write( "Could not reach rokud at %s: %s\n" % (SOCKET_FILE, err) )
+       return 1
+
+   sys.stdout.write( reply + "\n" )
+   return 0 if reply.startswith("ok") else 1
+
+
+#
+# Invocation Check:
+#
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
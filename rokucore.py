@@ -0,0 +1,3101 @@
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: rokucore.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: The parts of the remote that talk to the Roku: the ECP client,
+#           discovery, channel catalogs and configuration. Nothing here
+#           needs GTK, so scripts can use it without a display. Run with
+#           'python -m rokucore' for a command line remote.
+#
+################################################################################
+import time
+
+# Taken before anything else is imported so --timing covers the imports.
+STARTED = time.time()
+
+import os
+import re
+import sys
+import errno
+import fcntl
+import select
+import socket
+import struct
+import Queue
+import random
+import collections
+import hashlib
+import functools
+import os.path as op
+import requests
+import urlparse
+import threading
+
+import ecpxml
+import ecppipe
+
+# Bytes read at a time when parsing XML from the Roku.
+CHUNK_SIZE = 8192
+
+# Where the remote keeps its configuration.
+CONFIG_PATH = op.join(op.expanduser('~'), '.roku_remote')
+
+# These are keys recognized by the Roku ECP.
+KEYS = ["Home", "Rev", "Fwd", "Play", "Select", "Left", "Right",
+        "Down", "Up", "Back", "Info", "Backspace", "Search", "Enter"]
+
+# SSDP multicast group and port.
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+
+# How a search is run, in seconds: the longest it may take, when the
+# M-SEARCH is sent (each repeat up to SSDP_JITTER late, so repeats from
+# several remotes don't line up) and how long after the last new reply the
+# search is over. MX is how long devices may hold their reply back; a search
+# never ends on a quiet spell before MX (plus SSDP_MARGIN for the trip back)
+# has passed since the last M-SEARCH.
+SSDP_TIMEOUT = 2.5
+SSDP_SENDS   = (0.0, 0.2, 0.5)
+SSDP_JITTER  = 0.05
+SSDP_QUIET   = 0.35
+SSDP_MX      = 1
+SSDP_MARGIN  = 0.1
+
+# Port every Roku serves ECP on.
+ECP_PORT = 8060
+
+# Text typed to calibrate a model and the delays it is tried at, in seconds.
+CALIBRATION_TEXT   = "calibrate 0123456789"
+CALIBRATION_DELAYS = (0.2, 0.15, 0.1, 0.07, 0.05, 0.03)
+
+# ioctl requests for an interface's flags, IPv4 address and netmask, and the
+# flags that matter for discovery.
+SIOCGIFFLAGS   = 0x8913
+SIOCGIFADDR    = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP        = 0x1
+IFF_LOOPBACK  = 0x8
+IFF_MULTICAST = 0x1000
+
+# Address and model of the selected Roku.
+roku_addr  = ""
+roku_model = None
+
+# Open ECP clients, keyed by the base URL of the Roku they talk to.
+clients = {}
+clients_lock = threading.Lock()
+
+# The background queue that ECP commands are run from, and how it hands
+# results back. The GTK front end points notify at gobject.idle_add.
+commands = None
+notify = None
+
+# Channel catalog of the selected Roku, its content hash and where catalogs
+# are cached on disk.
+channels = {}
+channels_hash = None
+channel_dir = None
+
+# Versions of the selected Roku's channels by application id, as of the last
+# catalog refresh, and the cache of their icons. See IconCache.
+channel_versions = {}
+icons = None
+icon_dir = None
+
+# Extra Rokus that mirror every command sent to the selected one and the
+# Fanout serving them.
+mirror_urls = []
+fanout = None
+
+# Rokus seen on earlier searches. See DeviceRegistry.
+registry = None
+
+# Background watcher of the Rokus announcing themselves. See SsdpListener.
+listener = None
+
+# Circuit breakers by the base URL of their Roku, and the monitor probing
+# them. See CircuitBreaker and HealthMonitor.
+breakers = {}
+breakers_lock = threading.Lock()
+monitor = None
+
+# Text entry pacing for each model of Roku, and where calibrated floors are
+# saved. See Pacer and calibrate().
+pacers = {}
+pacing_file = None
+
+# Keys sent per pipelined batch for bursts that aren't paced, such as
+# several keys from the command line. One sends each key on its own through
+# requests. See EcpClient.post_many() and send_keys().
+pipeline_batch = 1
+
+# Key presses waiting for the command queue. See InputQueue.
+inputs = None
+
+# Saved macros by name, the file they are kept in and the recording in
+# progress, if any. See MacroRecorder.
+macros = {}
+macro_file = None
+recorder = None
+
+
+class LatencyStats(object):
+   """
+   Class to keep timings of ECP requests, per device and per endpoint. Only
+   the most recent WINDOW samples of each are kept, so the percentiles follow
+   how the device is behaving now rather than since start-up. Errors and
+   timeouts are counted for the whole run.
+   """
+
+   WINDOW = 500
+
+
+   def __init__(self):
+       self.series = {}
+       self.lock   = threading.Lock()
+
+
+   def record(self, device, endpoint, seconds, outcome='ok'):
+       """
+       Records one request. outcome is 'ok', 'error' or 'timeout'.
+       """
+       with self.lock:
+           key = (device, endpoint)
+           if key not in self.series:
+               self.series[key] = { 'samples'  : collections.deque( maxlen=self.WINDOW ),
+                                    'count'    : 0,
+                                    'errors'   : 0,
+                                    'timeouts' : 0 }
+           series = self.series[key]
+           series['count'] += 1
+           if outcome == 'timeout':
+               series['timeouts'] += 1
+           else:
+               if outcome == 'error':
+                   series['errors'] += 1
+               series['samples'].append( seconds )
+
+
+   def summary(self, device=None):
+       """
+       Returns a dictionary per (device, endpoint) with the request count,
+       error and timeout counts and the p50/p95/p99 latency in seconds.
+       """
+       rows = []
+       with self.lock:
+           for (dev, endpoint) in sorted( self.series ):
+               if device and dev != device:
+                   continue
+               series  = self.series[(dev, endpoint)]
+               samples = sorted( series['samples'] )
+               row = { 'device'   : dev,
+                       'endpoint' : endpoint,
+                       'count'    : series['count'],
+                       'errors'   : series['errors'],
+                       'timeouts' : series['timeouts'] }
+               for name, rank in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+                   row[name] = percentile( samples, rank )
+               rows.append( row )
+       return rows
+
+
+   def metrics_text(self):
+       """
+       Returns the stats in the Prometheus text format.
+       """
+       lines = [ '# TYPE roku_ecp_latency_seconds summary',
+                 '# TYPE roku_ecp_errors_total counter',
+                 '# TYPE roku_ecp_timeouts_total counter' ]
+       for row in self.summary():
+           labels = 'device="%s",endpoint="%s"' % (row['device'], row['endpoint'])
+           for name, quantile in (('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99')):
+               if row[name] is not None:
+                   lines.append( 'roku_ecp_latency_seconds{%s,quantile="%s"} %.6f'
+                                 % (labels, quantile, row[name]) )
+           lines.append( 'roku_ecp_latency_seconds_count{%s} %d' % (labels, row['count']) )
+           lines.append( 'roku_ecp_errors_total{%s} %d' % (labels, row['errors']) )
+           lines.append( 'roku_ecp_timeouts_total{%s} %d' % (labels, row['timeouts']) )
+       return '\n'.join(lines) + '\n'
+
+
+def percentile( samples, rank ):
+   """
+   Nearest-rank percentile of a sorted list, or None if it is empty.
+   """
+   if not samples:
+       return None
+   index = int( round(rank * (len(samples) - 1)) )
+   return samples[index]
+
+
+def endpoint_of( path ):
+   """
+   Reduces an ECP path to the endpoint it is counted under, e.g.
+   '/keypress/Home' is 'keypress' and '/query/apps' is 'query/apps'.
+   """
+   parts = path.lstrip('/').split('/')
+   if parts[0] == 'query' and len(parts) > 1:
+       return 'query/' + parts[1]
+   return parts[0]
+
+
+# Timings of every request made through an EcpClient.
+stats = LatencyStats()
+
+
+class EcpClient(object):
+   """
+   Class to hold a persistent, keep-alive connection to the ECP port of a
+   single Roku. Every request to the device should go through one of these so
+   button presses reuse an open socket instead of paying for a new handshake.
+   """
+
+   # Timeouts in seconds. Connecting to a box on the LAN is quick or it isn't
+   # going to happen; a sleeping Roku can be slow to answer once connected.
+   CONNECT_TIMEOUT = 1.0
+   READ_TIMEOUT    = 5.0
+
+   # Read timeouts for endpoints that shouldn't use READ_TIMEOUT. Keys are
+   # answered at once or not at all, while starting a channel can take a
+   # slow box a good while.
+   DEADLINES = { 'keypress' : 2.0,
+                 'keydown'  : 2.0,
+                 'keyup'    : 2.0,
+                 'launch'   : 10.0 }
+
+
+   def __init__(self, url, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+       self.base_url  = url.rstrip('/')
+       self.timeout   = (connect_timeout, read_timeout)
+       self.deadlines = dict( self.DEADLINES )
+       self.breaker   = get_breaker( url )
+
+       # A single device only needs a small pool. Retries are left off so a
+       # key press is never sent twice behind the user's back.
+       self.session = requests.Session()
+       adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                               pool_maxsize=4,
+                                               max_retries=0)
+       self.session.mount('http://', adapter)
+
+       # Raw connection for pipelined bursts, dropped if the device turns
+       # out not to handle them.
+       self.pipeline = ecppipe.PipelinedConnection( url, read_timeout )
+
+
+   def __str__(self):
+       return "%s" % self.base_url
+
+
+   def url_for(self, path):
+       """
+       Builds the full URL for an ECP path like '/keypress/Home'.
+       """
+       return self.base_url + '/' + path.lstrip('/')
+
+
+   def request(self, method, path, **kwargs):
+       """
+       Performs a request against the device and records how long it took.
+       For streamed responses that is the time until the headers arrived.
+       """
+       endpoint = endpoint_of( path )
+       kwargs.setdefault('timeout', (self.timeout[0],
+                                     self.deadlines.get(endpoint, self.timeout[1])))
+
+       # Don't wait on a device that is known to be down.
+       if not self.breaker.allow():
+           raise DeviceDown( "%s is not answering" % self.base_url )
+
+       start = time.time()
+       try:
+           response = self.session.request(method, self.url_for(path), **kwargs)
+       except requests.Timeout:
+           stats.record( self.base_url, endpoint, time.time() - start, 'timeout' )
+           self.breaker.failure()
+           raise
+       except requests.RequestException:
+           stats.record( self.base_url, endpoint, time.time() - start, 'error' )
+           self.breaker.failure()
+           raise
+
+       self.breaker.success()
+       outcome = 'error' if response.status_code >= 400 else 'ok'
+       stats.record( self.base_url, endpoint, time.time() - start, outcome )
+       return response
+
+
+   def get(self, path, **kwargs):
+       """
+       Performs a GET against the device.
+       """
+       return self.request('GET', path, **kwargs)
+
+
+   def post(self, path, **kwargs):
+       """
+       Performs a POST against the device. ECP commands carry no body.
+       """
+       return self.request('POST', path, **kwargs)
+
+
+   def post_many(self, paths):
+       """
+       Performs several POSTs and returns their status codes. They are sent
+       pipelined on the raw connection while the device copes with that.
+       Requests a failed batch is known not to have delivered, and every
+       batch after it, go through the session one request at a time.
+       """
+       if not self.breaker.allow():
+           raise DeviceDown( "%s is not answering" % self.base_url )
+
+       statuses = []
+       if self.pipeline:
+           statuses = self.post_pipelined( paths )
+
+       for path in paths[len(statuses):]:
+           statuses.append( self.post(path).status_code )
+       return statuses
+
+
+   def post_pipelined(self, paths):
+       """
+       Sends a batch on the raw connection and returns the status codes of
+       the replies that came back. If the rest can't be known to be unsent,
+       sending them again could repeat them, so that is an error instead.
+       """
+       reused = self.pipeline.is_open()
+       failed = None
+       try:
+           replies = self.pipeline.send_batch( paths )
+       except ecppipe.PipelineError as err:
+           replies = err.done
+           failed  = err
+           if not replies and reused and err.unsent:
+               # The device dropped the idle connection. Try a fresh one.
+               try:
+                   replies = self.pipeline.send_batch( paths )
+                   failed  = None
+               except ecppipe.PipelineError as err:
+                   replies = err.done
+                   failed  = err
+           if failed:
+               self.pipeline = None
+
+       for path, (status, seconds) in zip( paths, replies ):
+           outcome = 'error' if status >= 400 else 'ok'
+           stats.record( self.base_url, endpoint_of(path), seconds, outcome )
+
+       if failed and not failed.unsent:
+           self.breaker.failure()
+           raise requests.ConnectionError( "%s: %d of %d requests may or may not have been "
+                                           "carried out (%s)" % (self.base_url,
+                                           len(paths) - len(replies), len(paths), failed) )
+       return [ status for status, seconds in replies ]
+
+
+   def keypress(self, key):
+       """
+       Presses a single key on the device.
+       """
+       response = self.post('/keypress/' + key)
+       response.raise_for_status()
+       return response
+
+
+   def keydown(self, key):
+       """
+       Holds a key down. The device repeats it on its own until keyup().
+       """
+       response = self.post('/keydown/' + key)
+       response.raise_for_status()
+       return response
+
+
+   def keyup(self, key):
+       """
+       Releases a key held with keydown().
+       """
+       response = self.post('/keyup/' + key)
+       response.raise_for_status()
+       return response
+
+
+   def launch(self, app_id):
+       """
+       Launches the channel with the given application id.
+       """
+       response = self.post('/launch/' + app_id)
+       response.raise_for_status()
+       return response
+
+
+   def close(self):
+       """
+       Closes any pooled connections.
+       """
+       self.session.close()
+       if self.pipeline:
+           self.pipeline.close()
+
+
+class DeviceDown(requests.ConnectionError):
+   """
+   Raised at once, without touching the network, for requests to a device
+   whose circuit breaker is open.
+   """
+
+
+class CircuitBreaker(object):
+   """
+   Class to stop sending commands to a device that isn't answering. After
+   FAILURES connection failures or timeouts in a row the breaker opens and
+   requests fail at once with DeviceDown rather than each waiting out its
+   timeout. The health monitor closes it again as soon as a probe reaches
+   the device. Without a monitor, one request is let through every
+   RETRY_AFTER seconds to find out.
+   """
+
+   FAILURES    = 2
+   RETRY_AFTER = 10.0
+
+
+   def __init__(self, url):
+       self.url      = url
+       self.failures = 0
+       self.opened   = None
+       self.lock     = threading.Lock()
+
+
+   def is_open(self):
+       return self.opened is not None
+
+
+   def allow(self):
+       """
+       True if a request may go out now.
+       """
+       with self.lock:
+           if self.opened is None:
+               return True
+           if time.time() - self.opened >= self.RETRY_AFTER:
+               # Let this one through as a trial, and hold the rest off.
+               self.opened = time.time()
+               return True
+           return False
+
+
+   def success(self):
+       """
+       The device answered. Close the breaker.
+       """
+       with self.lock:
+           self.failures = 0
+           self.opened   = None
+
+
+   def failure(self):
+       """
+       A request failed to reach the device.
+       """
+       with self.lock:
+           self.failures += 1
+           if self.failures >= self.FAILURES and self.opened is None:
+               self.opened = time.time()
+
+
+   def trip(self):
+       """
+       A probe failed to reach the device. Open the breaker at once.
+       """
+       with self.lock:
+           self.failures = max( self.failures, self.FAILURES )
+           if self.opened is None:
+               self.opened = time.time()
+
+
+def get_breaker( url ):
+   """
+   Returns the circuit breaker for the Roku at url.
+   """
+   key = url.rstrip('/')
+   with breakers_lock:
+       if key not in breakers:
+           breakers[key] = CircuitBreaker( key )
+       return breakers[key]
+
+
+def probe( url, timeout=0.5 ):
+   """
+   True if the ECP port of the Roku at url accepts a connection.
+   """
+   parts = urlparse.urlsplit( url )
+   try:
+       socket.create_connection( (parts.hostname, parts.port or 80), timeout ).close()
+   except socket.error:
+       return False
+   return True
+
+
+class HealthMonitor(object):
+   """
+   Class to probe the selected and mirrored Rokus in the background. A
+   device whose breaker is open is probed every PROBE_INTERVAL seconds so it
+   comes back soon after it does; a healthy one every CHECK_INTERVAL, so one
+   that has gone away is noticed before the user presses anything. A failed
+   probe of a healthy device counts as one failure like any request, and
+   the device is probed again sooner to confirm it. A probe is just a TCP
+   connect to the ECP port.
+   """
+
+   PROBE_INTERVAL = 2.0
+   CHECK_INTERVAL = 15.0
+   PROBE_TIMEOUT  = 0.5
+
+   # Seconds between looks at the schedule.
+   TICK = 0.5
+
+
+   def __init__(self):
+       self.probed  = {}
+       self.running = False
+
+
+   def start(self):
+       self.running = True
+       worker = threading.Thread(target=self.run, name="health-monitor")
+       worker.daemon = True
+       worker.start()
+       return self
+
+
+   def stop(self):
+       self.running = False
+
+
+   def run(self):
+       """
+       Worker loop. Runs until stop() is called.
+       """
+       while self.running:
+           for url in [roku_addr] + list(mirror_urls):
+               if url:
+                   self.check( url )
+           time.sleep( self.TICK )
+
+
+   def check(self, url):
+       """
+       Probes a device if it is due.
+       """
+       breaker  = get_breaker( url )
+       if breaker.is_open() or breaker.failures:
+           interval = self.PROBE_INTERVAL
+       else:
+           interval = self.CHECK_INTERVAL
+       now = time.time()
+       if now - self.probed.get( breaker.url, 0 ) < interval:
+           return
+
+       self.probed[breaker.url] = now
+       if probe( url, self.PROBE_TIMEOUT ):
+           breaker.success()
+       elif breaker.is_open():
+           breaker.trip()
+       else:
+           # One lost SYN on Wi-Fi shouldn't grey the remote out.
+           breaker.failure()
+
+
+def start_monitor():
+   """
+   Starts the shared health monitor if it isn't running.
+   """
+   global monitor
+
+   if monitor is None:
+       monitor = HealthMonitor().start()
+   return monitor
+
+
+def is_down( url=None ):
+   """
+   True if the breaker for a Roku, by default the selected one, is open.
+   """
+   if url is None:
+       url = roku_addr
+   return bool( url ) and get_breaker( url ).is_open()
+
+
+class FanoutError(requests.RequestException):
+   """
+   Raised when a mirrored command failed on some of the devices. failed
+   holds the error for each of those devices by URL; the others carried the
+   command out.
+   """
+
+
+   def __init__(self, message, failed=None):
+       requests.RequestException.__init__(self, message)
+       self.failed = failed or {}
+
+
+class Fanout(object):
+   """
+   Class to send the same command to a group of Rokus at once. Every device
+   gets its own lane (a thread with a keep-alive client) so no device waits
+   on another. It offers the same keypress()/keydown()/keyup()/launch() calls
+   as EcpClient and can stand in for one.
+
+   Skew is how far apart the commands reached the devices, estimated as half
+   way through each request's round trip. A truly parallel fan-out keeps it
+   close to the spread in network latency.
+   """
+
+   # Number of recent skews kept.
+   HISTORY = 100
+
+
+   def __init__(self, urls):
+       self.urls  = list(urls)
+       self.skews = collections.deque( maxlen=self.HISTORY )
+
+       self.lanes = []
+       for url in self.urls:
+           lane = Queue.Queue()
+           worker = threading.Thread(target=self.run_lane, args=(url, lane),
+                                     name="fanout %s" % url)
+           worker.daemon = True
+           worker.start()
+           self.lanes.append(lane)
+
+
+   def run_lane(self, url, lane):
+       """
+       Worker loop for one device. Exits when it pulls None.
+       """
+       client = get_client( url )
+       while True:
+           item = lane.get()
+           if item is None:
+               return
+
+           method, args, results = item
+           sent = time.time()
+           try:
+               getattr( client, method )( *args )
+               error = None
+           except requests.RequestException as err:
+               error = err
+           answered = time.time()
+           results.put( (url, sent + (answered - sent) / 2, error) )
+
+
+   def send(self, method, *args, **kwargs):
+       """
+       Runs client.method(*args) on every device, or only on the devices
+       listed in urls=, and waits for them all. Returns the skew in seconds.
+       """
+       urls = kwargs.get('urls')
+
+       results = Queue.Queue()
+       lanes   = 0
+       for url, lane in zip(self.urls, self.lanes):
+           if urls is None or url in urls:
+               lane.put( (method, args, results) )
+               lanes += 1
+
+       arrivals = []
+       errors   = []
+       failed   = {}
+       for count in range(0, lanes):
+           url, arrived, error = results.get()
+           if error:
+               errors.append( "%s: %s" % (url, error) )
+               failed[url] = error
+           else:
+               arrivals.append( arrived )
+
+       skew = 0.0
+       if arrivals:
+           skew = max(arrivals) - min(arrivals)
+           self.skews.append( skew )
+
+       if errors:
+           raise FanoutError( "; ".join(errors), failed )
+
+       return skew
+
+
+   def keypress(self, key):
+       """
+       Presses a key on every device.
+       """
+       return self.send( 'keypress', key )
+
+
+   def keydown(self, key):
+       """
+       Holds a key down on every device.
+       """
+       return self.send( 'keydown', key )
+
+
+   def keyup(self, key):
+       """
+       Releases a held key on every device.
+       """
+       return self.send( 'keyup', key )
+
+
+   def launch(self, app_id):
+       """
+       Launches a channel on every device.
+       """
+       return self.send( 'launch', app_id )
+
+
+   def skew_stats(self):
+       """
+       Returns the (last, mean, worst) skew over the recent history.
+       """
+       if not self.skews:
+           return (0.0, 0.0, 0.0)
+       skews = list(self.skews)
+       return (skews[-1], sum(skews) / len(skews), max(skews))
+
+
+   def close(self):
+       """
+       Stops the lanes.
+       """
+       for lane in self.lanes:
+           lane.put(None)
+
+
+def get_target():
+   """
+   Returns what commands should be sent through: the client for the
+   selected Roku, or a Fanout when other Rokus are mirroring it.
+   """
+   global fanout
+
+   if not mirror_urls:
+       return get_client()
+
+   urls = [roku_addr] + [ url for url in mirror_urls if url != roku_addr ]
+   if fanout is None or fanout.urls != urls:
+       if fanout:
+           fanout.close()
+       fanout = Fanout( urls )
+
+   return fanout
+
+
+def get_client( url=None ):
+   """
+   Returns the shared ECP client for the given Roku URL, defaulting to the
+   currently selected Roku. Clients are created on first use and kept open.
+   """
+   if url is None:
+       url = roku_addr
+
+   key = url.rstrip('/')
+   with clients_lock:
+       if key not in clients:
+           clients[key] = EcpClient(url)
+       return clients[key]
+
+
+class CommandQueue(object):
+   """
+   Class to run ECP commands in order on a dedicated I/O thread so the GTK
+   main loop never waits on the network. Results and errors are handed back
+   through notify, which the GUI sets to queue idle callbacks.
+   """
+
+
+   def __init__(self, notify=None):
+       self.notify   = notify or call_now
+       self.commands = Queue.Queue()
+
+       self.worker = threading.Thread(target=self.run, name="ecp-commands")
+       self.worker.daemon = True
+       self.worker.start()
+
+
+   def submit(self, func, args=(), done=None, error=None):
+       """
+       Queues func(*args) to run after every command already submitted.
+       'done' is called with the result and 'error' with the exception, both
+       through notify.
+       """
+       self.commands.put( (func, args, done, error) )
+
+
+   def run(self):
+       """
+       Worker loop. Runs forever as a daemon thread.
+       """
+       while True:
+           func, args, done, error = self.commands.get()
+           try:
+               result = func(*args)
+           except Exception as err:
+               self.report( error or report_error, err )
+           else:
+               if done:
+                   self.report( done, result )
+
+
+   def report(self, callback, value):
+       """
+       Hands a callback to the main loop. The wrapper returns False so the
+       idle handler only fires once.
+       """
+       def idle_callback():
+           callback(value)
+           return False
+
+       self.notify(idle_callback)
+
+
+def call_now( callback ):
+   """
+   Default notify for the command queue: without a main loop to return to,
+   callbacks simply run on the worker thread.
+   """
+   callback()
+
+
+def report_error( err ):
+   """
+   Default error handler for queued commands.
+   """
+   if sys.stderr:
+       sys.stderr.write( "Roku command failed: %s\n" % err )
+
+
+def get_queue():
+   """
+   Returns the shared command queue, starting its worker on first use.
+   """
+   global commands
+
+   if commands is None:
+       commands = CommandQueue( notify )
+
+   return commands
+
+
+class InputQueue(object):
+   """
+   Class to hold key presses from the user until the command thread can send
+   them. The queue is bounded and a full queue turns input away rather than
+   letting it pile up behind a slow device. Repeated presses of one key are
+   merged into a single entry, up to max_repeat presses, and input older
+   than max_age by the time it comes up is dropped, so a device that catches
+   up does not replay seconds of stale presses.
+
+   Entries are [action, key, count, time] where action is 'keypress',
+   'keydown' or 'keyup'. A keyup is never turned away or dropped once its
+   keydown has been sent, so a key can't be left held on the Roku.
+   """
+
+   MAX_PENDING = 16
+   MAX_REPEAT  = 5
+   MAX_AGE     = 0.75
+
+
+   def __init__(self, max_pending=MAX_PENDING, max_repeat=MAX_REPEAT, max_age=MAX_AGE):
+       self.max_pending = max_pending
+       self.max_repeat  = max_repeat
+       self.max_age     = max_age
+
+       self.pending  = collections.deque()
+       self.skipped  = set()
+       self.draining = False
+       self.lock     = threading.Lock()
+
+       # Presses merged away, turned away and dropped as stale.
+       self.coalesced = 0
+       self.rejected  = 0
+       self.stale     = 0
+
+
+   def push(self, action, key):
+       """
+       Adds a key action. Returns False if the queue is full and it was
+       turned away.
+       """
+       now = time.time()
+       with self.lock:
+           last = self.pending[-1] if self.pending else None
+
+           # A click whose keydown never left the queue is just a keypress.
+           if action == 'keyup' and last and last[0] == 'keydown' and last[1] == key:
+               self.pending.pop()
+               action = 'keypress'
+               last = self.pending[-1] if self.pending else None
+
+           if action == 'keypress' and last and last[0] == 'keypress' and last[1] == key:
+               if last[2] < self.max_repeat:
+                   last[2] += 1
+               self.coalesced += 1
+               last[3] = now
+               return True
+
+           if action != 'keyup' and len(self.pending) >= self.max_pending:
+               self.rejected += 1
+               return False
+
+           self.pending.append( [action, key, 1, now] )
+           if self.draining:
+               return True
+           self.draining = True
+
+       get_queue().submit( self.drain )
+       return True
+
+
+   def drain(self):
+       """
+       Sends everything pending. Runs on the command thread; new input that
+       arrives meanwhile is picked up by the same run.
+       """
+       try:
+           while True:
+               with self.lock:
+                   if not self.pending:
+                       self.draining = False
+                       return
+                   action, key, count, when = self.pending.popleft()
+
+                   if action == 'keyup' and key in self.skipped:
+                       self.skipped.discard( key )
+                       continue
+
+                   if action != 'keyup' and time.time() - when > self.max_age:
+                       self.stale += count
+                       if action == 'keydown':
+                           self.skipped.add( key )
+                       continue
+
+               target = get_target()
+               for press in range(0, count):
+                   getattr( target, action )( key )
+       except Exception:
+           # The device is failing, so what is left would only go stale,
+           # but held keys still get their release.
+           with self.lock:
+               self.pending = collections.deque( entry for entry in self.pending
+                                                 if entry[0] == 'keyup' )
+               self.draining = bool( self.pending )
+           if self.draining:
+               get_queue().submit( self.drain )
+           raise
+
+
+   def counts(self):
+       """
+       Returns how much input was coalesced, turned away and dropped.
+       """
+       return { 'coalesced' : self.coalesced,
+                'rejected'  : self.rejected,
+                'stale'     : self.stale }
+
+
+def get_inputs():
+   """
+   Returns the shared input queue.
+   """
+   global inputs
+
+   if inputs is None:
+       inputs = InputQueue()
+
+   return inputs
+
+
+class Pacer(object):
+   """
+   Class to pace literal key presses for text entry. Each model of Roku has
+   a floor, the shortest delay it is trusted to take characters at. A Roku
+   too busy for a character usually still answers 200 and quietly drops it,
+   so nothing the remote sees proves a shorter delay safe; the floor only
+   comes down through calibrate(), where a person checks the typed text.
+
+   Above the floor the pacer reacts to the signals there are: a refused
+   request, a timeout or a sudden jump in round trip time means the box is
+   falling behind, so the delay is doubled and the character retried. Every
+   clean key press trims it back towards the floor. None of that is saved.
+   """
+
+   # Delays are in seconds between the start of one key press and the next.
+   # An uncalibrated model gets DEFAULT_FLOOR, just under the fixed 0.3 s the
+   # remote always used. MIN_DELAY is as low as a calibration may go.
+   DEFAULT_FLOOR = 0.25
+   MIN_DELAY     = 0.02
+   MAX_DELAY     = 1.0
+   STEP_DOWN     = 0.005
+
+   # A round trip this many times the running average counts as a stall.
+   SPIKE_RATIO = 3.0
+   RETRIES     = 3
+
+
+   def __init__(self, floor=DEFAULT_FLOOR):
+       self.floor = max( self.MIN_DELAY, floor )
+       self.delay = self.floor
+       self.rtt   = None
+
+
+   def back_off(self):
+       """
+       The device showed signs of dropping input. Slow down.
+       """
+       self.delay = min( self.MAX_DELAY, self.delay * 2 )
+
+
+   def speed_up(self):
+       """
+       The device kept up. Shave a little off the delay.
+       """
+       self.delay = max( self.floor, self.delay - self.STEP_DOWN )
+
+
+   def send(self, client, key):
+       """
+       Presses a key, retrying with a longer delay if the device chokes, then
+       waits out whatever is left of the current delay.
+       """
+       press = client.keypress
+       for attempt in range(0, self.RETRIES + 1):
+           start = time.time()
+           try:
+               press( key )
+           except FanoutError as err:
+               # Mirrored: the key reached every other box, so only the ones
+               # that refused it get it again. Unreachable ones are left be.
+               retry = [ url for url, error in err.failed.items()
+                         if not isinstance( error, requests.ConnectionError ) ]
+               if not retry or attempt == self.RETRIES:
+                   raise
+               self.back_off()
+               press = functools.partial( client.send, 'keypress', urls=retry )
+               time.sleep( self.delay )
+               continue
+           except requests.ConnectionError:
+               # An unreachable box isn't a slow one; there is nothing to
+               # learn and no point in retrying.
+               raise
+           except requests.RequestException:
+               self.back_off()
+               if attempt == self.RETRIES:
+                   raise
+               time.sleep( self.delay )
+               continue
+
+           rtt = time.time() - start
+           if self.rtt and rtt > self.rtt * self.SPIKE_RATIO:
+               self.back_off()
+           else:
+               self.speed_up()
+
+           # Keep a running average so one slow reply doesn't skew it.
+           if self.rtt is None:
+               self.rtt = rtt
+           else:
+               self.rtt = 0.8 * self.rtt + 0.2 * rtt
+
+           time.sleep( max(0, self.delay - rtt) )
+           return
+
+
+def get_pacer( model=None ):
+   """
+   Returns the pacer for a model of Roku, defaulting to the selected one.
+   Calibrated floors are loaded from the pacing file on first use.
+   """
+   # yaml is slow to import and one-shot commands never need it, so the
+   # import is left until the configuration is actually read.
+   import yaml
+
+   if model is None:
+       model = roku_model
+
+   if not pacers and pacing_file:
+       try:
+           pace_file = open( pacing_file, 'r' )
+           saved = yaml.safe_load( pace_file ) or {}
+           pace_file.close()
+       except (IOError, yaml.YAMLError):
+           saved = {}
+
+       # Files from before calibration hold delays learned without any check
+       # that the text arrived, so only calibrated floors are taken.
+       floors = saved.get( 'calibrated' ) if isinstance( saved, dict ) else None
+       for each in floors or {}:
+           pacers[each] = Pacer( floors[each] )
+
+   if model not in pacers:
+       pacers[model] = Pacer()
+
+   return pacers[model]
+
+
+def save_pacing():
+   """
+   Writes the calibrated floor of each model to the pacing file.
+   """
+   import yaml
+
+   if not pacing_file:
+       return
+
+   floors = {}
+   for each in pacers:
+       if each and pacers[each].floor != Pacer.DEFAULT_FLOOR:
+           floors[each] = pacers[each].floor
+
+   try:
+       pace_file = open( pacing_file, 'w' )
+   except IOError:
+       sys.stderr.write("Could not open %s for writing!\n" % pacing_file)
+       return
+
+   yaml.safe_dump( { 'calibrated': floors }, pace_file, default_flow_style=False )
+   pace_file.close()
+
+
+def calibrate( client, model, confirm ):
+   """
+   Finds how fast a model of Roku takes text without dropping any. The
+   calibration text is typed into a text field the user has open (the
+   search screen will do) at each of CALIBRATION_DELAYS, slowest first, and
+   confirm(delay) asks whether it arrived exactly; ECP can't read the field
+   back, so someone has to look. The field is cleared after every try. The
+   first miss, or any sign of the box stalling, ends it. The shortest delay
+   confirmed becomes the model's floor and is saved. Returns the floor.
+   """
+   pacer = get_pacer( model )
+   keys  = [ 'Lit_' + ('%20' if letter == ' ' else letter) for letter in CALIBRATION_TEXT ]
+   clear = Pacer()
+
+   confirmed = None
+   for delay in CALIBRATION_DELAYS:
+       trial = Pacer( delay )
+       send_keys( client, keys, trial )
+       clean = trial.delay <= delay and confirm( delay )
+       send_keys( client, ['Backspace'] * len(keys), clear )
+       if not clean:
+           break
+       confirmed = delay
+
+   if confirmed is not None:
+       pacer.floor = confirmed
+       pacer.delay = max( pacer.delay, confirmed )
+       save_pacing()
+   return pacer.floor
+
+
+class Roku(object):
+   """
+   Class to contain data for the Rokus on the network.
+   """
+
+   DIAL_URN = 'dial/dd.xml'
+
+
+   def __init__(self, url, usn=None):
+       self.url = url
+       self.usn = usn
+       self.client = get_client(url)
+
+       # Filled in by get_dial_data() or from the device registry.
+       self.friendly_name = None
+       self.model_name    = None
+       self.model_number  = None
+       self.serial_number = None
+
+
+   def __str__(self):
+       return "%s" % self.url
+
+
+   def __repr__(self):
+
+
+       if self.friendly_name:
+           return "%s (%s)" % (self.friendly_name, self.url)
+       if self.model_name:
+           return "%s (%s)" % (self.model_name, self.url)
+       return "%s" % self.url
+
+
+   def get_dial_data(self, timeout=None):
+       """
+       Parses the DIAL config file from the Roku to find parameters of interest.
+       """
+       if timeout:
+           code = self.client.get( self.DIAL_URN, timeout=timeout, stream=True )
+       else:
+           code = self.client.get( self.DIAL_URN, stream=True )
+
+       name_map = {
+           '3100X' : 'Roku 2 XS',
+           '4200X' : 'Roku 3',
+       }
+
+       # Items of interest:
+       # <friendlyName>
+       # <modelName>
+       # <modelNumber>
+       # <serialNumber>
+       info = ecpxml.parse_device_info( code.iter_content(CHUNK_SIZE) )
+
+       if 'friendlyName' in info:
+           self.friendly_name = info['friendlyName']
+
+       if 'modelNumber' in info:
+           self.model_name = info['modelNumber']
+           if self.model_name in name_map:
+               self.model_name = name_map[self.model_name]
+
+       if 'modelName' in info:
+           self.model_number = info['modelName']
+
+       if 'serialNumber' in info:
+           self.serial_number = info['serialNumber']
+
+       # A Roku found without SSDP gets the USN it would have announced.
+       if not self.usn and self.serial_number:
+           self.usn = 'uuid:roku:ecp:%s' % self.serial_number
+
+
+class DeviceRegistry(object):
+   """
+   Class to remember Rokus between searches. Entries are keyed by the SSDP
+   USN and hold the location, the DIAL fields and when the device was last
+   heard from. An entry is fresh for as long as the CACHE-CONTROL max-age the
+   device advertised; fresh devices can be shown without asking them again.
+   """
+
+   # Used when a device does not say how long its reply is good for.
+   DEFAULT_MAX_AGE = 3600
+
+   DIAL_FIELDS = ('friendly_name', 'model_name', 'model_number', 'serial_number')
+
+
+   def __init__(self, file_name=None):
+       self.file_name = file_name
+       self.entries   = {}
+       self.lock      = threading.Lock()
+       self.load()
+
+
+   def load(self):
+       """
+       Reads the registry file, if there is one.
+       """
+       import yaml
+
+       if not self.file_name:
+           return
+
+       try:
+           reg_file = open( self.file_name, 'r' )
+           entries = yaml.safe_load( reg_file ) or {}
+           reg_file.close()
+       except (IOError, yaml.YAMLError):
+           entries = {}
+
+       with self.lock:
+           self.entries = entries
+
+
+   def save(self):
+       """
+       Writes the registry back to disk.
+       """
+       import yaml
+
+       if not self.file_name:
+           return
+
+       try:
+           reg_file = open( self.file_name, 'w' )
+       except IOError:
+           sys.stderr.write("Could not open %s for writing!\n" % self.file_name)
+           return
+
+       with self.lock:
+           yaml.safe_dump( self.entries, reg_file, default_flow_style=False )
+       reg_file.close()
+
+
+   def update(self, roku, max_age=None):
+       """
+       Records a Roku whose DIAL data has just been read.
+       """
+       if not roku.usn:
+           return
+
+       with self.lock:
+           entry = self.entries.setdefault( roku.usn, {} )
+           entry['location']  = roku.url
+           entry['last_seen'] = time.time()
+           entry['max_age']   = max_age or entry.get('max_age', self.DEFAULT_MAX_AGE)
+           for field in self.DIAL_FIELDS:
+               entry[field] = getattr( roku, field )
+
+
+   def seen(self, usn, location, max_age=None):
+       """
+       Notes that a known device answered a search. Unknown devices are left
+       for update() so an entry never exists without its DIAL data.
+       """
+       with self.lock:
+           if usn not in self.entries:
+               return
+           entry = self.entries[usn]
+           entry['location']  = location
+           entry['last_seen'] = time.time()
+           if max_age:
+               entry['max_age'] = max_age
+
+
+   def is_fresh(self, usn, location=None):
+       """
+       True if the entry is within its max-age (and, if a location is given,
+       the device is still at it).
+       """
+       with self.lock:
+           entry = self.entries.get(usn)
+           if not entry:
+               return False
+           if location and entry.get('location') != location:
+               return False
+           age = time.time() - entry.get('last_seen', 0)
+           return age < entry.get('max_age', self.DEFAULT_MAX_AGE)
+
+
+   def usn_at(self, location):
+       """
+       Returns the USN of the device last seen at location, or None.
+       """
+       with self.lock:
+           for usn in self.entries:
+               if self.entries[usn].get('location') == location:
+                   return usn
+       return None
+
+
+   def roku(self, usn):
+       """
+       Builds a Roku from a registry entry without contacting it.
+       """
+       with self.lock:
+           entry = dict( self.entries[usn] )
+
+       roku = Roku( entry['location'], usn )
+       for field in self.DIAL_FIELDS:
+           setattr( roku, field, entry.get(field) )
+       return roku
+
+
+   def known(self):
+       """
+       Returns a Roku for every device in the registry, most recently seen
+       first.
+       """
+       with self.lock:
+           order = sorted( self.entries,
+                           key=lambda usn: self.entries[usn].get('last_seen', 0),
+                           reverse=True )
+       return [ self.roku(usn) for usn in order ]
+
+
+def device_sort_key( roku ):
+   """
+   Orders Rokus by the name the user knows them by.
+   """
+   return ( (roku.friendly_name or roku.model_name or roku.url).lower(), roku.url )
+
+
+class DeviceSet(object):
+   """
+   Class to hold the Rokus found by a search, indexed by USN. Devices often
+   answer an M-SEARCH more than once; claim() lets the receive loop throw the
+   repeats away in constant time, however many devices respond.
+   """
+
+
+   def __init__(self):
+       self.claimed = set()
+       self.devices = {}
+       self.lock    = threading.Lock()
+
+
+   def claim(self, usn):
+       """
+       Returns True the first time a USN is seen, False after that.
+       """
+       with self.lock:
+           if usn in self.claimed:
+               return False
+           self.claimed.add(usn)
+           return True
+
+
+   def add(self, roku):
+       """
+       Stores a resolved Roku.
+       """
+       with self.lock:
+           self.claimed.add( roku.usn or roku.url )
+           self.devices[ roku.usn or roku.url ] = roku
+
+
+   def get(self, usn):
+       """
+       Returns the resolved Roku with the given USN, or None.
+       """
+       with self.lock:
+           return self.devices.get(usn)
+
+
+   def __contains__(self, usn):
+       with self.lock:
+           return usn in self.devices
+
+
+   def __len__(self):
+       with self.lock:
+           return len(self.devices)
+
+
+   def __iter__(self):
+       """
+       Iterates over the resolved Rokus in display order.
+       """
+       with self.lock:
+           rokus = self.devices.values()
+       return iter( sorted(rokus, key=device_sort_key) )
+
+
+class DialResolver(object):
+   """
+   Class to fetch DIAL data for discovered Rokus on a pool of worker threads.
+   A slow or dead box only ties up its own worker, and the pool grows while
+   devices are waiting so a big network doesn't queue up behind a few of
+   them. finish() bounds how long discovery waits for the stragglers.
+   """
+
+   WORKERS     = 4
+   MAX_WORKERS = 32
+
+   # Seconds any single device gets to hand over its DIAL data, counted from
+   # when a worker starts on it.
+   DEADLINE = 2.0
+
+
+   def __init__(self, devices, found=None, workers=WORKERS, deadline=DEADLINE,
+                max_workers=MAX_WORKERS):
+       self.devices     = devices
+       self.found       = found
+       self.deadline    = deadline
+       self.max_workers = max( workers, max_workers )
+       self.pending     = Queue.Queue()
+       self.lock        = threading.Lock()
+       self.closed      = False
+       self.busy        = 0
+
+       self.threads = []
+       for count in range(0, workers):
+           self.start_worker()
+
+
+   def start_worker(self):
+       worker = threading.Thread(target=self.run, name="dial-%d" % len(self.threads))
+       worker.daemon = True
+       worker.start()
+       self.threads.append(worker)
+
+
+   def submit(self, roku):
+       """
+       Queues a Roku to have its DIAL data read, adding a worker if every
+       one is already busy.
+       """
+       self.pending.put( roku )
+       with self.lock:
+           idle = len(self.threads) - self.busy
+           if self.pending.qsize() > idle and len(self.threads) < self.max_workers:
+               self.start_worker()
+
+
+   def run(self):
+       """
+       Worker loop. Exits when it pulls the None placed by finish().
+       """
+       while True:
+           roku = self.pending.get()
+           if roku is None or self.closed:
+               return
+
+           with self.lock:
+               self.busy += 1
+           try:
+               roku.get_dial_data( timeout=(EcpClient.CONNECT_TIMEOUT, self.deadline) )
+           except (requests.RequestException, SyntaxError) as err:
+               if sys.stderr:
+                   sys.stderr.write( "No DIAL data from %s: %s\n" % (roku, err) )
+               continue
+           finally:
+               with self.lock:
+                   self.busy -= 1
+
+           # Results that show up after finish() gave up are dropped.
+           with self.lock:
+               if self.closed:
+                   return
+               self.devices.add(roku)
+
+           if self.found:
+               self.found(roku)
+
+
+   def finish(self):
+       """
+       Waits until every queued device is resolved or out of time.
+       """
+       with self.lock:
+           workers = len(self.threads)
+           backlog = self.pending.qsize()
+           for worker in self.threads:
+               self.pending.put(None)
+
+       # Each worker finishes the device it is on and then takes its share of
+       # the backlog, and no device takes longer than the connect timeout
+       # plus the deadline.
+       rounds  = 1 + (backlog + workers - 1) // workers
+       give_up = time.time() + rounds * (EcpClient.CONNECT_TIMEOUT + self.deadline)
+       for worker in self.threads:
+           worker.join( max(0, give_up - time.time()) )
+
+       with self.lock:
+           self.closed = True
+
+       skipped = 0
+       while True:
+           try:
+               if self.pending.get_nowait() is not None:
+                   skipped += 1
+           except Queue.Empty:
+               break
+       if skipped and sys.stderr:
+           sys.stderr.write( "Gave up on %d devices waiting for DIAL data\n" % skipped )
+
+
+class Launcher(object):
+   """
+   Class to contain data for the channel launcher buttons.
+   """
+
+
+   def __init__(self, disp_name, chan_name=None):
+       if not chan_name:
+           self.disp_name = disp_name
+           self.chan_name = disp_name
+           return
+       self.disp_name  = disp_name
+       self.chan_name  = chan_name
+       self.button_ref = None
+
+
+def check_key( key ):
+   """
+   Raises SyntaxError unless key is one the Roku ECP recognizes.
+   """
+   if key not in KEYS:
+       error = "'%s' not in valid key press list." % key
+       raise SyntaxError, error
+
+
+def channel_id( channel, catalog=None ):
+   """
+   Returns the application id for a channel given by name, by an id in the
+   catalog, by a numeric id or explicitly as 'id:<id>' (for ids like
+   tvinput.hdmi1 on a Roku TV). Returns None if it can't be resolved.
+   """
+   if catalog is None:
+       catalog = channels
+
+   channel = channel.strip('"')
+   if channel in catalog:
+       return catalog[channel].strip('"')
+   if channel in [ app_id.strip('"') for app_id in catalog.values() ]:
+       return channel
+   if channel.startswith('id:') and channel[3:]:
+       return channel[3:]
+   if channel.isdigit():
+       return channel
+   return None
+
+
+def get_channels( versions=None ):
+   """
+   Queries the channels installed on the targeted Roku. Channel versions are
+   stored in versions, by application id, if it is given.
+   """
+
+   code = get_client().get("/query/apps", stream=True)
+
+   # The catalog is parsed as it streams in rather than line by line, so
+   # channel names may hold any character XML allows.
+   return ecpxml.parse_channels( code.iter_content(CHUNK_SIZE), versions )
+
+
+def catalog_hash( catalog ):
+   """
+   Returns a hash of a channel catalog that only changes with its contents.
+   """
+   digest = hashlib.sha1()
+   for name in sorted( catalog ):
+       digest.update( (u"%s=%s\n" % (name, catalog[name])).encode('utf-8') )
+   return digest.hexdigest()
+
+
+def catalog_file( url ):
+   """
+   Returns the file a Roku's channel catalog is cached in.
+   """
+   return op.join( channel_dir, re.sub(r'[^A-Za-z0-9]+', '_', url).strip('_') + '.yml' )
+
+
+def load_channels( url=None ):
+   """
+   Loads the cached channel catalog for a Roku and makes it current. Returns
+   the catalog, which is empty if nothing was cached.
+   """
+   import yaml
+
+   global channels
+   global channels_hash
+   global channel_versions
+
+   if url is None:
+       url = roku_addr
+
+   # Versions come with the next refresh.
+   channel_versions = {}
+
+   catalog = {}
+   if channel_dir and url:
+       try:
+           cat_file = open( catalog_file(url), 'r' )
+           catalog = yaml.safe_load( cat_file ) or {}
+           cat_file.close()
+       except (IOError, yaml.YAMLError):
+           catalog = {}
+
+   channels = catalog
+   channels_hash = catalog_hash( catalog )
+   return catalog
+
+
+def save_channels( url, catalog ):
+   """
+   Writes a channel catalog to the cache.
+   """
+   import yaml
+
+   if not channel_dir:
+       return
+
+   try:
+       if not op.isdir( channel_dir ):
+           os.makedirs( channel_dir )
+       cat_file = open( catalog_file(url), 'w' )
+   except (IOError, OSError):
+       sys.stderr.write("Could not open %s for writing!\n" % catalog_file(url))
+       return
+
+   yaml.safe_dump( catalog, cat_file, default_flow_style=False )
+   cat_file.close()
+
+
+def refresh_channels( changed=None ):
+   """
+   Fetches the channel catalog in the background. The cache is only written,
+   and changed() only called, if the catalog actually changed.
+   """
+   url = roku_addr
+   if not url:
+       return
+
+   versions = {}
+
+   def catalog_loaded( catalog ):
+       global channels
+       global channels_hash
+       global channel_versions
+
+       # The user may have picked another Roku in the meantime.
+       if url != roku_addr:
+           return
+
+       # Versions don't count towards the hash; a channel update only
+       # changes its icon.
+       channel_versions = versions
+
+       new_hash = catalog_hash( catalog )
+       if new_hash == channels_hash:
+           return
+
+       channels = catalog
+       channels_hash = new_hash
+       save_channels( url, catalog )
+       if changed:
+           changed()
+
+   get_queue().submit( get_channels, (versions,), done=catalog_loaded )
+
+
+class IconCache(object):
+   """
+   Class to keep channel icons in memory and on disk, keyed by application
+   id and version so an updated channel gets its new icon. Both levels are
+   bounded in bytes and drop the least recently used icons first. Icons are
+   fetched on a worker of their own so they never hold up key presses.
+   """
+
+   # Bytes of icons kept in memory and on disk.
+   MEMORY_BYTES = 2 * 1024 * 1024
+   DISK_BYTES   = 16 * 1024 * 1024
+
+
+   def __init__(self, directory=None, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES):
+       self.directory    = directory
+       self.memory_bytes = memory_bytes
+       self.disk_bytes   = disk_bytes
+       self.lock         = threading.Lock()
+
+       # Icon data and file sizes by key, least recently used first.
+       self.memory = collections.OrderedDict()
+       self.disk   = collections.OrderedDict()
+       self.misses = 0
+
+       self.queue = None
+       self.load()
+
+
+   def key(self, app_id, version):
+       """
+       Returns the cache key, which doubles as the file name, for an icon.
+       """
+       return re.sub( r'[^A-Za-z0-9.]+', '_', "%s_%s" % (app_id, version or '') ) + '.img'
+
+
+   def path(self, key):
+       return op.join( self.directory, key )
+
+
+   def load(self):
+       """
+       Indexes the icons already on disk, oldest use first.
+       """
+       if not self.directory or not op.isdir( self.directory ):
+           return
+
+       entries = []
+       for name in os.listdir( self.directory ):
+           if not name.endswith( '.img' ):
+               continue
+           try:
+               info = os.stat( self.path(name) )
+           except OSError:
+               continue
+           entries.append( (info.st_mtime, name, info.st_size) )
+
+       for mtime, name, size in sorted( entries ):
+           self.disk[name] = size
+
+
+   def find(self, app_id, version):
+       """
+       Returns the key of the cached icon for a channel. Without a version
+       any cached version will do.
+       """
+       if version is not None:
+           return self.key( app_id, version )
+
+       prefix = self.key( app_id, None )[:-len('.img')]
+       for key in reversed( self.memory.keys() + self.disk.keys() ):
+           if key.startswith( prefix ):
+               return key
+       return None
+
+
+   def get(self, app_id, version=None):
+       """
+       Returns a cached icon, or None if it has to be fetched.
+       """
+       with self.lock:
+           key = self.find( app_id, version )
+           if key in self.memory:
+               data = self.memory.pop( key )
+               self.memory[key] = data
+               return data
+           if key not in self.disk:
+               return None
+
+       try:
+           icon_file = open( self.path(key), 'rb' )
+           data = icon_file.read()
+           icon_file.close()
+           # Mark the icon used so it survives the next trim and restart.
+           os.utime( self.path(key), None )
+       except (IOError, OSError):
+           with self.lock:
+               self.disk.pop( key, None )
+           return None
+
+       with self.lock:
+           if key in self.disk:
+               self.disk[key] = self.disk.pop( key )
+           self.remember( key, data )
+       return data
+
+
+   def put(self, app_id, version, data):
+       """
+       Adds an icon to both levels, replacing any other version of it.
+       """
+       key = self.key( app_id, version )
+       old_versions = []
+
+       with self.lock:
+           prefix = self.key( app_id, None )[:-len('.img')]
+           for stale in self.memory.keys():
+               if stale.startswith( prefix ) and stale != key:
+                   del self.memory[stale]
+           old_versions = [ stale for stale in self.disk
+                            if stale.startswith( prefix ) and stale != key ]
+           self.remember( key, data )
+
+       if not self.directory:
+           return
+
+       try:
+           if not op.isdir( self.directory ):
+               os.makedirs( self.directory )
+           # Written aside and renamed so a reader never sees half an icon.
+           icon_file = open( self.path(key) + '.tmp', 'wb' )
+           icon_file.write( data )
+           icon_file.close()
+           os.rename( self.path(key) + '.tmp', self.path(key) )
+       except (IOError, OSError):
+           return
+
+       with self.lock:
+           self.disk.pop( key, None )
+           self.disk[key] = len(data)
+           for stale in old_versions:
+               self.drop( stale )
+           while sum( self.disk.values() ) > self.disk_bytes and len(self.disk) > 1:
+               self.drop( next(iter(self.disk)) )
+
+
+   def remember(self, key, data):
+       """
+       Adds an icon to memory and trims it. Called with the lock held.
+       """
+       self.memory.pop( key, None )
+       self.memory[key] = data
+       size = sum( len(each) for each in self.memory.values() )
+       while size > self.memory_bytes and len(self.memory) > 1:
+           old_key, old_data = self.memory.popitem( last=False )
+           size -= len(old_data)
+
+
+   def drop(self, key):
+       """
+       Removes an icon from disk. Called with the lock held.
+       """
+       self.disk.pop( key, None )
+       try:
+           os.unlink( self.path(key) )
+       except OSError:
+           pass
+
+
+   def fetch(self, app_id, version=None, client=None):
+       """
+       Returns a channel's icon, from the cache if it can.
+       """
+       data = self.get( app_id, version )
+       if data is not None:
+           return data
+
+       self.misses += 1
+       response = (client or get_client()).get( "/query/icon/%s" % app_id )
+       response.raise_for_status()
+       data = response.content
+       self.put( app_id, version, data )
+       return data
+
+
+   def request(self, app_id, version=None, done=None, wanted=None):
+       """
+       Fetches an icon in the background and hands it to done(). wanted(),
+       if given, is asked again just before the fetch so icons scrolled out
+       of sight in the meantime are skipped.
+       """
+       data = self.get( app_id, version )
+       if data is not None:
+           if done:
+               done( data )
+           return
+
+       if self.queue is None:
+           self.queue = CommandQueue( notify )
+
+       def fetch_if_wanted():
+           if wanted and not wanted():
+               return None
+           return self.fetch( app_id, version )
+
+       def fetched( data ):
+           if data is not None and done:
+               done( data )
+
+       self.queue.submit( fetch_if_wanted, done=fetched )
+
+
+def get_icons():
+   """
+   Returns the shared icon cache.
+   """
+   global icons
+
+   if icons is None:
+       icons = IconCache( icon_dir )
+
+   return icons
+
+
+def send_keys( client, keys, pacer=None, batch=None ):
+   """
+   Presses a list of keys. Through a pacer each key goes out on its own,
+   spaced to what the model can take. Without one the keys are a burst that
+   needs no pacing (navigation from the command line, say) and go out in
+   pipelined batches of batch keys if the client can send them.
+   """
+   if pacer:
+       # A pipelined batch lands on the box all at once, so a pacer can't
+       # space it out; the keys a busy box drops are gone without a trace.
+       for key in keys:
+           pacer.send( client, key )
+       return
+
+   if batch is None:
+       batch = pipeline_batch
+
+   if batch <= 1 or not hasattr( client, 'post_many' ):
+       for key in keys:
+           client.keypress( key )
+       return
+
+   for start in range(0, len(keys), batch):
+       chunk = keys[start:start + batch]
+       for key, status in zip( chunk, client.post_many([ '/keypress/' + key for key in chunk ]) ):
+           if status >= 400:
+               raise requests.HTTPError( "%s: keypress %s failed with %d" % (client, key, status) )
+
+
+def type_text( client, text, pacer ):
+   """
+   Sends each character of text as a literal key press. Run it on the command
+   thread so the pause between characters does not block the main loop.
+   """
+   keys = []
+   for letter in text:
+       if letter == ' ':
+           letter = '%20'
+       keys.append( "Lit_" + letter )
+
+   send_keys( client, keys, pacer )
+
+
+class MacroRecorder(object):
+   """
+   Class to capture keypress, keydown, keyup and launch commands as they are
+   sent. Steps are kept in the same 'command argument' form buttons are
+   registered with. Short pauses are just the user finding the next button
+   and are dropped, but a long one usually means they were waiting for a
+   screen to load, so it is kept as an explicit wait. How long a key was
+   held is always kept, so a held scroll plays back as far as it went; a
+   hold shorter than TAP_GAP was just a click and is kept as a keypress.
+   """
+
+   # Pauses at least this long, in seconds, are kept as waits.
+   HOLD_GAP = 1.0
+
+   # Holds shorter than this, in seconds, end before the Roku starts to
+   # repeat the key.
+   TAP_GAP = 0.4
+
+
+   def __init__(self):
+       self.steps = []
+       self.last  = None
+
+
+   def record(self, command, argument):
+       """
+       Adds a command to the recording.
+       """
+       now = time.time()
+       tapped = self.steps and self.steps[-1] == "keydown %s" % argument
+       if command == 'keyup' and tapped and now - self.last < self.TAP_GAP:
+           self.steps[-1] = "keypress %s" % argument
+       elif command == 'keyup':
+           # Whatever came since, the key was down all this time.
+           self.steps.append( "wait %.2f" % (now - self.last) )
+           self.steps.append( "keyup %s" % argument )
+       else:
+           if self.last is not None and now - self.last >= self.HOLD_GAP:
+               self.steps.append( "wait %.1f" % (now - self.last) )
+           self.steps.append( "%s %s" % (command, argument) )
+       self.last = now
+
+
+def start_recording():
+   """
+   Starts recording commands for a new macro.
+   """
+   global recorder
+   recorder = MacroRecorder()
+
+
+def record_command( command, argument ):
+   """
+   Adds a command to the macro being recorded. Does nothing otherwise.
+   """
+   if recorder:
+       recorder.record( command, argument )
+
+
+def stop_recording():
+   """
+   Stops recording and returns the steps that were captured.
+   """
+   global recorder
+
+   if not recorder:
+       return []
+   steps = recorder.steps
+   recorder = None
+   return steps
+
+
+def compile_macro( steps, catalog=None ):
+   """
+   Checks a macro's steps and resolves them to (command, argument) pairs
+   ready for run_macro(): key names are validated, channel names looked up
+   in catalog and waits turned into seconds. Raises SyntaxError on the
+   first bad step, so nothing is sent for a macro that can't finish.
+   """
+   if catalog is None:
+       catalog = channels
+
+   compiled = []
+   for step in steps:
+       parts    = step.split(None, 1)
+       command  = parts[0].lower() if parts else ""
+       argument = parts[1] if len(parts) > 1 else ""
+
+       if command in ('keypress', 'keydown', 'keyup'):
+           for key in argument.split():
+               check_key( key )
+               compiled.append( (command, key) )
+
+       elif command == 'launch':
+           app_id = channel_id( argument, catalog )
+           if app_id is None:
+               raise SyntaxError, '"%s" is not a valid channel.' % argument
+           compiled.append( ('launch', app_id) )
+
+       elif command == 'wait':
+           try:
+               compiled.append( ('wait', float(argument)) )
+           except ValueError:
+               raise SyntaxError, '"%s" is not a valid wait.' % argument
+
+       else:
+           raise SyntaxError, '"%s" is not a valid command.' % step
+
+   return compiled
+
+
+def get_macro( name, catalog=None ):
+   """
+   Returns the compiled steps of a saved macro.
+   """
+   if name not in macros:
+       raise SyntaxError, '"%s" is not a saved macro.' % name
+   return compile_macro( macros[name], catalog )
+
+
+def run_macro( target, compiled, pacer ):
+   """
+   Sends the steps of a compiled macro back to back. Keys go through the
+   pacer, so they are sent as fast as the model has shown it can take them
+   rather than at the speed they were recorded. Held keys are held for as
+   long as the macro waits between their keydown and keyup. Run it on the
+   command thread.
+   """
+   keys = []
+   for command, argument in compiled:
+       if command == 'keypress':
+           keys.append( argument )
+           continue
+
+       # Runs of keys between other steps go out together.
+       send_keys( target, keys, pacer )
+       keys = []
+       if command == 'launch':
+           target.launch( argument )
+       elif command == 'keydown':
+           target.keydown( argument )
+       elif command == 'keyup':
+           target.keyup( argument )
+       else:
+           time.sleep( argument )
+   send_keys( target, keys, pacer )
+
+
+def load_macros():
+   """
+   Reads the saved macros from the macro file.
+   """
+   import yaml
+
+   global macros
+
+   macros = {}
+   if not macro_file or not op.isfile( macro_file ):
+       return macros
+
+   try:
+       mac_file = open( macro_file, 'r' )
+       saved = yaml.safe_load( mac_file ) or {}
+       mac_file.close()
+   except (IOError, yaml.YAMLError):
+       saved = {}
+
+   for name in saved:
+       if isinstance( saved[name], list ):
+           macros[name] = [ step for step in saved[name] if isinstance(step, basestring) ]
+   return macros
+
+
+def save_macros():
+   """
+   Writes the saved macros to the macro file.
+   """
+   import yaml
+
+   if not macro_file:
+       return
+
+   try:
+       mac_file = open( macro_file, 'w' )
+   except IOError:
+       sys.stderr.write("Could not open %s for writing!\n" % macro_file)
+       return
+
+   yaml.safe_dump( macros, mac_file, default_flow_style=False )
+   mac_file.close()
+
+
+def add_macro( name, steps ):
+   """
+   Saves steps as the macro called name, replacing any macro of that name.
+   """
+   macros[name] = list( steps )
+   save_macros()
+
+
+def ssdp_headers( message ):
+   """
+   Returns the headers of an SSDP message as a dictionary with lower case
+   names, or None if it isn't one. 'max-age' is pulled out of Cache-Control
+   as a number when present.
+   """
+   lines = message.split('\r\n')
+   if not lines or not lines[0].strip():
+       return None
+
+   headers = {}
+   for line in lines[1:]:
+       name, colon, value = line.partition(':')
+       if colon:
+           headers[name.strip().lower()] = value.strip()
+
+   age = re.search(r'max-age\s*=\s*(\d+)', headers.get('cache-control', ''), re.IGNORECASE)
+   if age:
+       headers['max-age'] = int( age.group(1) )
+   return headers
+
+
+def find_rokus( net=None, devices=None, event=None, found=None, registry=None, target=None,
+                sweep='auto', expect=None, quiet=SSDP_QUIET ):
+   """
+   Send out an SSDP packet requesting Rokus to identify themselves. Each new
+   device is passed to found() as soon as its DIAL data has been read, rather
+   than waiting for the search to time out. Devices are resolved in parallel,
+   see DialResolver. With a registry, devices whose entry is still fresh are
+   not asked for their DIAL data again. Results are collected in 'devices',
+   a DeviceSet, which is also returned. 'target' sends the search to a single
+   (address, port) instead of the multicast group, e.g. to a mockroku.
+
+   The search goes out on every interface in 'net', a name or a list of
+   names, or on every interface list_interfaces() finds if it is None. The
+   replies are read in one loop and a device answering on more than one
+   interface is only listed once.
+
+   The M-SEARCH is repeated on the SSDP_SENDS schedule in case a packet is
+   lost. The search ends once every device has had its MX to answer the
+   last M-SEARCH, something has answered and nothing new has for 'quiet'
+   seconds. Otherwise it runs for SSDP_TIMEOUT.
+
+   'expect' is for checking that a known set of devices is still there: the
+   search ends the moment every USN in it has answered, without waiting out
+   MX, so devices it doesn't list may well be missed. A search meant to find
+   new devices must not pass it.
+
+   Where multicast is blocked nothing answers, so by default ('auto') a
+   search that found nothing goes on to sweep the interfaces' subnets for
+   the ECP port, see sweep_subnet(). sweep=True sweeps after every search
+   and False never does. A search sent to a 'target' is never followed by
+   an automatic sweep.
+   """
+   if devices is None:
+       devices = DeviceSet()
+
+   # DISCOVER will look for all Roku ECP devices.
+   DISCOVER =  'M-SEARCH * HTTP/1.1\r\n' +\
+               'HOST:%s:%s\r\n' % (SSDP_ADDR, SSDP_PORT) +\
+               'ST:roku:ecp\r\n'         +\
+               'MX:%d\r\n' % SSDP_MX    +\
+               'MAN:"ssdp:discover"\r\n'
+
+   if net is None:
+       interfaces = list_interfaces()
+   else:
+       if isinstance( net, basestring ):
+           net = [net]
+       interfaces = [ (name, interface_address(name)) for name in net ]
+
+   # One socket per interface, each on its own port so replies come back on
+   # the interface that asked. Nothing here blocks, so there is no need for
+   # socket.setdefaulttimeout() and the rest of the process is left alone.
+   socks = []
+   for name, address in interfaces:
+       if not address:
+           continue
+       sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+       try:
+           sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                           socket.inet_aton(address))
+           sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+           sock.bind((address, 0))
+           sock.setblocking(0)
+           sock.sendto(DISCOVER, target or (SSDP_ADDR, SSDP_PORT))
+       except socket.error:
+           # The interface went away or can't reach the target. The others
+           # may still do.
+           sock.close()
+           continue
+       socks.append(sock)
+
+   # Cache the DIAL data of everything resolved during this search.
+   max_ages = {}
+
+   def resolved( roku ):
+       if registry:
+           registry.update( roku, max_ages.get(roku.usn) )
+       if found:
+           found( roku )
+
+   # DIAL data is read in parallel while more replies come in.
+   resolver = DialResolver( devices, resolved )
+
+   start    = time.time()
+   deadline = start + SSDP_TIMEOUT
+   sends    = [ start + offset + random.uniform(0, SSDP_JITTER) for offset in SSDP_SENDS[1:] ]
+   last_new = start
+
+   # Replies to the last M-SEARCH may take up to MX to arrive.
+   settled = start + SSDP_MX + SSDP_MARGIN
+
+   # Hosts that answered the search, so a sweep can leave them alone, and
+   # the USNs heard from.
+   answered = set()
+   heard    = set()
+
+   while socks:
+       now = time.time()
+       if now >= deadline:
+           break
+       if expect and heard >= set(expect):
+           break
+       if not sends and heard and now >= settled and now - last_new >= quiet:
+           break
+
+       if sends and sends[0] <= now:
+           sends.pop(0)
+           settled = now + SSDP_MX + SSDP_MARGIN
+           for sock in socks:
+               try:
+                   sock.sendto(DISCOVER, target or (SSDP_ADDR, SSDP_PORT))
+               except socket.error:
+                   pass
+           continue
+
+       # Sleep until a reply, the next M-SEARCH or the end of the search.
+       wake = deadline
+       if sends:
+           wake = min( wake, sends[0] )
+       elif heard:
+           wake = min( wake, max(settled, last_new + quiet) )
+
+       readable = select.select( socks, [], [], max(0, wake - now) )[0]
+       for sock in readable:
+           try:
+               reply = sock.recv(2048)
+           except socket.error:
+               continue
+
+           headers = ssdp_headers( reply )
+           if not headers:
+               continue
+
+           location = headers.get('location')
+           usn      = headers.get('usn')
+           if not (location and usn and 'st' in headers):
+               continue
+
+           if 'max-age' in headers:
+               max_ages[usn] = headers['max-age']
+           answered.add( urlparse.urlsplit(location).hostname )
+           heard.add( usn )
+
+           # Sometimes devices will respond multiple times, or on more than
+           # one interface.
+           if not devices.claim( usn ):
+               continue
+           last_new = time.time()
+
+           # Only go back to the device if the cached copy has expired.
+           if registry and registry.is_fresh( usn, location ):
+               registry.seen( usn, location, max_ages.get(usn) )
+               roku = registry.roku( usn )
+               devices.add( roku )
+               if found:
+                   found( roku )
+           else:
+               resolver.submit( Roku(location, usn) )
+
+   if sweep is True or (sweep == 'auto' and not target and not answered):
+       def port_open( host ):
+           if host in answered:
+               return
+           url = 'http://%s:%d/' % (host, ECP_PORT)
+
+           usn = registry.usn_at( url ) if registry else None
+           if usn and registry.is_fresh( usn, url ):
+               if devices.claim( usn ):
+                   registry.seen( usn, url )
+                   roku = registry.roku( usn )
+                   devices.add( roku )
+                   if found:
+                       found( roku )
+           else:
+               resolver.submit( Roku(url) )
+
+       for name, address in interfaces:
+           if address:
+               sweep_subnet( name, address, port_open )
+
+   resolver.finish()
+
+   if registry:
+       registry.save()
+   for sock in socks:
+       sock.close()
+
+   # Set the event so the main thread knows to continue.
+   if event:
+       event.set()
+
+   return devices
+
+
+class SsdpListener(object):
+   """
+   Class to keep a live table of the Rokus on the network from the NOTIFY
+   messages they multicast: ssdp:alive when they come up and every so often
+   after that, and ssdp:byebye when they go away. An entry also lapses when
+   its max-age runs out without another alive. New devices have their DIAL
+   data read, or taken from the registry while it is fresh, before they are
+   listed.
+
+   'changed' is called with ('alive', roku) or ('byebye', roku) from the
+   listener's threads as devices come and go.
+   """
+
+   # Seconds an alive holds for when it doesn't say.
+   DEFAULT_MAX_AGE = 1800
+
+   # Seconds between checks for lapsed entries and for stop().
+   POLL = 1.0
+
+
+   def __init__(self, changed=None, port=SSDP_PORT, interfaces=None):
+       self.changed    = changed
+       self.port       = port
+       self.interfaces = interfaces
+
+       # USN -> [Roku or None while it is being resolved, expiry time]
+       self.devices = {}
+       self.lock    = threading.Lock()
+       self.sock    = None
+       self.running = False
+
+
+   def start(self):
+       """
+       Joins the SSDP group on every interface and starts listening. Raises
+       socket.error if the port can't be bound.
+       """
+       sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+       sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+       if hasattr(socket, 'SO_REUSEPORT'):
+           sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+       sock.bind(('', self.port))
+
+       for name, address in (self.interfaces or list_interfaces()):
+           membership = struct.pack('4s4s', socket.inet_aton(SSDP_ADDR),
+                                    socket.inet_aton(address))
+           try:
+               sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+           except socket.error:
+               # Already joined through another interface with the same
+               # address, or the interface went away.
+               continue
+
+       self.sock    = sock
+       self.running = True
+       worker = threading.Thread(target=self.run, name="ssdp-listener")
+       worker.daemon = True
+       worker.start()
+       return self
+
+
+   def stop(self):
+       """
+       Stops listening. The socket is closed within POLL seconds.
+       """
+       self.running = False
+
+
+   def run(self):
+       """
+       Worker loop. Runs until stop() is called.
+       """
+       sock = self.sock
+       try:
+           while self.running:
+               if select.select( [sock], [], [], self.POLL )[0]:
+                   try:
+                       self.handle( sock.recv(2048) )
+                   except socket.error:
+                       pass
+               self.expire()
+       finally:
+           sock.close()
+
+
+   def handle(self, message):
+       """
+       Acts on one SSDP message. Anything but a Roku's NOTIFY is ignored.
+       """
+       if not message.startswith('NOTIFY'):
+           return
+
+       headers = ssdp_headers( message )
+       usn = headers.get('usn')
+       if not usn or 'roku:ecp' not in headers.get('nt', ''):
+           return
+
+       kind = headers.get('nts', '').lower()
+       if kind == 'ssdp:byebye':
+           self.remove( usn )
+       elif kind == 'ssdp:alive' and headers.get('location'):
+           self.alive( usn, headers['location'], headers.get('max-age') )
+
+
+   def alive(self, usn, location, max_age=None):
+       """
+       Notes that a device is up, resolving it first if it is new or moved.
+       """
+       expires = time.time() + (max_age or self.DEFAULT_MAX_AGE)
+       with self.lock:
+           entry = self.devices.get( usn )
+           if entry and (entry[0] is None or entry[0].url == location):
+               entry[1] = expires
+               return
+           self.devices[usn] = [None, expires]
+
+       # DIAL data can take a while; don't hold up the next announcement.
+       worker = threading.Thread(target=self.resolve, args=(usn, location),
+                                 name="ssdp-resolve")
+       worker.daemon = True
+       worker.start()
+
+
+   def resolve(self, usn, location):
+       """
+       Reads the DIAL data of a newly announced device and lists it. If that
+       fails the placeholder left by alive() goes, so the next announcement
+       tries again.
+       """
+       listed = False
+       try:
+           if registry and registry.is_fresh( usn, location ):
+               roku = registry.roku( usn )
+           else:
+               roku = Roku( location, usn )
+               try:
+                   roku.get_dial_data( DialResolver.DEADLINE )
+               except (requests.RequestException, SyntaxError) as err:
+                   if sys.stderr:
+                       sys.stderr.write( "No DIAL data from %s: %s\n" % (roku, err) )
+                   return
+               if registry:
+                   registry.update( roku )
+
+           with self.lock:
+               if usn not in self.devices:
+                   return
+               self.devices[usn][0] = roku
+               listed = True
+       finally:
+           if not listed:
+               with self.lock:
+                   entry = self.devices.get( usn )
+                   if entry and entry[0] is None:
+                       del self.devices[usn]
+
+       if self.changed:
+           self.changed( 'alive', roku )
+
+
+   def add(self, roku, max_age=None):
+       """
+       Lists a device found some other way, e.g. by find_rokus().
+       """
+       with self.lock:
+           known = self.devices.get( roku.usn )
+           self.devices[roku.usn] = [roku, time.time() + (max_age or self.DEFAULT_MAX_AGE)]
+
+       if self.changed and not (known and known[0]):
+           self.changed( 'alive', roku )
+
+
+   def remove(self, usn):
+       """
+       Drops a device from the table.
+       """
+       with self.lock:
+           entry = self.devices.pop( usn, None )
+
+       if entry and entry[0] and self.changed:
+           self.changed( 'byebye', entry[0] )
+
+
+   def expire(self):
+       """
+       Drops every device whose last alive has run out.
+       """
+       now = time.time()
+       with self.lock:
+           lapsed = [ usn for usn in self.devices if self.devices[usn][1] < now ]
+       for usn in lapsed:
+           self.remove( usn )
+
+
+   def online(self):
+       """
+       Returns the devices currently up, sorted for display.
+       """
+       with self.lock:
+           rokus = [ entry[0] for entry in self.devices.values() if entry[0] ]
+       return sorted( rokus, key=device_sort_key )
+
+
+   def is_online(self, url):
+       """
+       True if the device at url is currently up.
+       """
+       url = url.rstrip('/')
+       return any( roku.url.rstrip('/') == url for roku in self.online() )
+
+
+def start_listener( changed=None ):
+   """
+   Starts the shared SSDP listener if it isn't running. Returns it, or None
+   if port 1900 couldn't be bound.
+   """
+   global listener
+
+   if listener is None:
+       try:
+           listener = SsdpListener( changed ).start()
+       except socket.error as err:
+           if sys.stderr:
+               sys.stderr.write( "Could not listen for Rokus: %s\n" % err )
+           return None
+   return listener
+
+
+def stop_listener():
+   """
+   Stops the shared SSDP listener.
+   """
+   global listener
+
+   if listener:
+       listener.stop()
+       listener = None
+
+
+def neighbours( name ):
+   """
+   Returns the IPv4 addresses the kernel has a link layer address for on an
+   interface, from /proc/net/arp. These hosts are known to be up.
+   """
+   hosts = []
+   try:
+       arp_file = open('/proc/net/arp', 'r')
+   except IOError:
+       return hosts
+
+   # IP address, HW type, Flags, HW address, Mask, Device
+   for line in arp_file.readlines()[1:]:
+       fields = line.split()
+       if len(fields) < 6 or fields[5] != name:
+           continue
+       if int(fields[2], 16) & 0x2:
+           hosts.append( fields[0] )
+   arp_file.close()
+
+   return hosts
+
+
+def sweep_hosts( name, address, netmask ):
+   """
+   Returns the addresses to sweep on an interface: its neighbours first,
+   then the rest of the subnet. Subnets bigger than a /24 are cut down to
+   the /24 around the interface's address, neighbours excepted.
+   """
+   ip   = struct.unpack('!I', socket.inet_aton(address))[0]
+   mask = struct.unpack('!I', socket.inet_aton(netmask))[0]
+
+   network = ip & mask
+   known = []
+   for host in neighbours( name ):
+       number = struct.unpack('!I', socket.inet_aton(host))[0]
+       if number & mask == network and number != ip:
+           known.append( host )
+
+   mask      = max( mask, 0xffffff00 )
+   network   = ip & mask
+   broadcast = network | (~mask & 0xffffffff)
+
+   hosts = list( known )
+   listed = set( known )
+   for number in range(network + 1, broadcast):
+       host = socket.inet_ntoa( struct.pack('!I', number) )
+       if number != ip and host not in listed:
+           hosts.append( host )
+   return hosts
+
+
+def scan_port( hosts, port=ECP_PORT, found=None, timeout=0.3, concurrency=128 ):
+   """
+   Tries a TCP connect to port on every host, at most 'concurrency' at a
+   time, and calls found(host) for each one that accepts. Hosts are tried in
+   order. Returns the hosts with the port open.
+   """
+   waiting = collections.deque( hosts )
+   probing = {}
+   accepted = []
+
+   while waiting or probing:
+       while waiting and len(probing) < concurrency:
+           host = waiting.popleft()
+           sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+           sock.setblocking(0)
+           result = sock.connect_ex( (host, port) )
+           if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+               probing[sock] = (host, time.time() + timeout)
+           else:
+               sock.close()
+
+       if not probing:
+           break
+
+       # A connect has finished, one way or the other, once it is writable.
+       connected = select.select( [], list(probing), [], 0.05 )[1]
+       for sock in connected:
+           host = probing.pop( sock )[0]
+           if sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR ) == 0:
+               accepted.append( host )
+               if found:
+                   found( host )
+           sock.close()
+
+       now = time.time()
+       for sock in [ each for each in probing if probing[each][1] < now ]:
+           del probing[sock]
+           sock.close()
+
+   return accepted
+
+
+def sweep_subnet( name, address, found=None ):
+   """
+   Looks for Rokus on an interface's subnet without multicast, by trying the
+   ECP port of every host. found(host) is called for each one listening.
+   With 128 connects in flight a /24 takes well under a second.
+   """
+   probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   try:
+       info = fcntl.ioctl(probe.fileno(), SIOCGIFNETMASK, struct.pack('256s', name[:15]))
+   except IOError:
+       return []
+   finally:
+       probe.close()
+
+   netmask = socket.inet_ntoa(info[20:24])
+   return scan_port( sweep_hosts(name, address, netmask), ECP_PORT, found )
+
+
+def interface_address( name ):
+   """
+   Returns the IPv4 address of a network interface, or None if it has none.
+   """
+   probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   try:
+       info = fcntl.ioctl(probe.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15]))
+   except IOError:
+       return None
+   finally:
+       probe.close()
+   return socket.inet_ntoa(info[20:24])
+
+
+def interface_flags( name ):
+   """
+   Returns the IFF_* flags of a network interface, or 0 if it is gone.
+   """
+   probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   try:
+       info = fcntl.ioctl(probe.fileno(), SIOCGIFFLAGS, struct.pack('256s', name[:15]))
+   except IOError:
+       return 0
+   finally:
+       probe.close()
+   return struct.unpack('H', info[16:18])[0]
+
+
+def list_interfaces():
+   """
+   Returns (name, address) for every interface discovery can search on:
+   up, able to multicast, not loopback and with an IPv4 address. Uses
+   /proc/net/dev for the names.
+   """
+   interfaces = []
+   addresses  = set()
+
+   net_file = open('/proc/net/dev', 'r')
+   for line in net_file:
+       # Interface rows are 'name: counters...'; the two header rows aren't.
+       if ':' not in line:
+           continue
+       name = line.split(':', 1)[0].strip()
+
+       flags = interface_flags( name )
+       if not flags & IFF_UP or not flags & IFF_MULTICAST or flags & IFF_LOOPBACK:
+           continue
+
+       address = interface_address( name )
+       if address and address not in addresses:
+           addresses.add( address )
+           interfaces.append( (name, address) )
+   net_file.close()
+
+   return interfaces
+
+
+def detect_ethernet():
+   """
+   Returns the first interface discovery can search on, or 'NO_IF'.
+   """
+   interfaces = list_interfaces()
+   if interfaces:
+       return interfaces[0][0]
+   return 'NO_IF'
+
+
+def get_config_files( config_path=CONFIG_PATH ):
+   """
+   Returns the paths of the configuration files kept under config_path.
+   """
+   return {
+       'device'   : op.join(config_path, 'default_device.yml'),
+       'launcher' : op.join(config_path, 'launchers.yml'),
+       'pacing'   : op.join(config_path, 'pacing.yml'),
+       'registry' : op.join(config_path, 'devices.yml'),
+       'channels' : op.join(config_path, 'channels'),
+       'macros'   : op.join(config_path, 'macros.yml'),
+       'icons'    : op.join(config_path, 'icon_cache'),
+   }
+
+
+def read_device_file( file_name ):
+   """
+   Returns the (address, model name) saved in the default device file, or
+   ("", None) if no device has been chosen.
+   """
+   import yaml
+
+   if not op.isfile( file_name ):
+       return ("", None)
+
+   dev_file    = open( file_name, 'r' )
+   device_info = list( yaml.load_all( dev_file ))
+   dev_file.close()
+
+   if len(device_info) == 2:
+       return (device_info[0], device_info[1])
+   return ("", None)
+
+
+def use_config( config_files ):
+   """
+   Points the library at the pacing, registry, channel and icon cache and
+   macro files, and loads the saved macros.
+   """
+   global pacing_file
+   global registry
+   global channel_dir
+   global icon_dir
+   global macro_file
+
+   pacing_file = config_files['pacing']
+   registry    = DeviceRegistry( config_files['registry'] )
+   channel_dir = config_files['channels']
+   icon_dir    = config_files['icons']
+   macro_file  = config_files['macros']
+   load_macros()
+
+
+def select_device( address, model=None ):
+   """
+   Makes the Roku at address the target of every command.
+   """
+   global roku_addr
+   global roku_model
+
+   roku_addr  = address
+   roku_model = model
+
+
+def main( argv ):
+   """
+   Command line remote. Without --device the saved default device is used.
+   """
+   import argparse
+
+   global pipeline_batch
+
+   parser = argparse.ArgumentParser( prog="python -m rokucore",
+                                     description="Send commands to a Roku." )
+   parser.add_argument( '-d', '--device',
+                        help="ECP address of the Roku, e.g. http://192.168.1.20:8060/" )
+   parser.add_argument( '-c', '--config', default=CONFIG_PATH,
+                        help="configuration directory (default: %(default)s)" )
+   parser.add_argument( '-t', '--timing', action='store_true',
+                        help="report how long the command took, imports included" )
+   parser.add_argument( '-b', '--batch', type=int, default=1,
+                        help="keys per pipelined batch for keypress bursts (default: %(default)s)" )
+
+   actions = parser.add_subparsers( dest='action' )
+   press = actions.add_parser( 'keypress', help="press one or more keys" )
+   press.add_argument( 'keys', nargs='+', choices=KEYS, metavar='KEY' )
+   start = actions.add_parser( 'launch', help="launch a channel by name or id (id:<id> for "
+                                              "ids that aren't numbers)" )
+   start.add_argument( 'channel' )
+   text = actions.add_parser( 'text', help="type text into the Roku" )
+   text.add_argument( 'text' )
+   replay = actions.add_parser( 'macro', help="play a saved macro" )
+   replay.add_argument( 'name' )
+   actions.add_parser( 'channels', help="list the installed channels" )
+   actions.add_parser( 'calibrate', help="find how fast this model of Roku takes text" )
+   search = actions.add_parser( 'discover', help="search the network for Rokus" )
+   search.add_argument( '--sweep', action='store_true',
+                        help="also try port %d on every host of the local subnets" % ECP_PORT )
+   actions.add_parser( 'listen', help="print Rokus as they come and go" )
+
+   args = parser.parse_args( argv )
+   config_files = get_config_files( args.config )
+   pipeline_batch = args.batch
+
+   if args.action == 'discover':
+       if not list_interfaces():
+           sys.stderr.write( "No Network Interface Found!\n" )
+           return 1
+
+       def found( roku ):
+           sys.stdout.write( "%s\t%s\t%s\n" % (roku.url, roku.model_name or '',
+                                                 roku.friendly_name or '') )
+
+       find_rokus( found=found, sweep=args.sweep or 'auto' )
+
+   elif args.action == 'listen':
+       def changed( kind, roku ):
+           sys.stdout.write( "%s\t%s\t%s\n" % (kind, roku.url, roku.model_name or '') )
+           sys.stdout.flush()
+
+       use_config( config_files )
+       if not start_listener( changed ):
+           return 1
+       try:
+           while True:
+               time.sleep( 1 )
+       except KeyboardInterrupt:
+           stop_listener()
+
+   else:
+       if args.device:
+           select_device( args.device )
+       else:
+           address, model = read_device_file( config_files['device'] )
+           if not address:
+               sys.stderr.write( "No device selected. Use --device or pick one in the app.\n" )
+               return 1
+           select_device( address, model )
+
+       # An unreachable box is the usual failure; say so in one line.
+       try:
+           client = get_client()
+           if args.action == 'keypress':
+               send_keys( client, args.keys )
+
+           elif args.action == 'launch':
+               # Only go to the Roku for the catalog when it is needed.
+               app_id = channel_id( args.channel, {} )
+               if app_id is None:
+                   app_id = channel_id( args.channel, get_channels() )
+               if app_id is None:
+                   sys.stderr.write( '"%s" is not a valid channel!\n' % args.channel )
+                   return 1
+               client.launch( app_id )
+
+           elif args.action == 'text':
+               use_config( config_files )
+               type_text( client, args.text, get_pacer() )
+
+           elif args.action == 'macro':
+               use_config( config_files )
+               try:
+                   # The cached catalog saves a round trip when it has every
+                   # channel the macro launches.
+                   try:
+                       compiled = get_macro( args.name, load_channels() )
+                   except SyntaxError:
+                       compiled = get_macro( args.name, get_channels() )
+               except SyntaxError as err:
+                   sys.stderr.write( "%s\n" % err )
+                   return 1
+               run_macro( client, compiled, get_pacer() )
+
+           elif args.action == 'calibrate':
+               use_config( config_files )
+               roku = Roku( roku_addr )
+               roku.get_dial_data()
+
+               def confirm( delay ):
+                   answer = raw_input( 'Typed at %d ms a key. Did "%s" arrive exactly? [y/N] '
+                                       % (delay * 1000, CALIBRATION_TEXT) )
+                   return answer.strip().lower().startswith('y')
+
+               sys.stdout.write( "Open a text field on the %s, e.g. Search, then press Enter. "
+                                 % roku.model_name )
+               raw_input()
+               floor = calibrate( client, roku.model_name, confirm )
+               sys.stdout.write( "Text goes to the %s at %d ms a key.\n" % (roku.model_name, floor * 1000) )
+
+           elif args.action == 'channels':
+               catalog = get_channels()
+               for name in sorted( catalog ):
+                   sys.stdout.write( "%s\t%s\n" % (catalog[name], name.encode('utf-8')) )
+       except requests.ConnectionError:
+           sys.stderr.write( "Could not reach the Roku at %s\n" % roku_addr )
+           return 1
+       except requests.RequestException as err:
+           sys.stderr.write( "%s: %s\n" % (roku_addr, err) )
+           return 1
+
+   if args.timing:
+       sys.stderr.write( "%.1f ms\n" % ((time.time() - STARTED) * 1000) )
+   return 0
+
+
+#
+# Invocation Check:
+#
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
@@ -0,0 +1,401 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2015 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: rokud.py
+#
+# @Author: Phil Smith
+#
+# @Date: Sun, 18-Oct-26 10:12AM
+#
+# @Project: Roku Remote
+#
+# @Purpose: Resident remote. Holds the selected device, its channel catalog
+#           and a warm connection, and takes commands over a Unix socket
+#           and a small local HTTP API. rokuc.py is the matching client.
+#
+################################################################################
+import os
+import sys
+import json
+import urllib
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import os.path as op
+
+import rokucore
+
+# Where the daemon listens by default. The HTTP API only binds to loopback.
+SOCKET_FILE = op.join(rokucore.CONFIG_PATH, 'rokud.sock')
+HTTP_PORT   = 8061
+
+# Host names the HTTP API answers to. Anything else in the Host header is a
+# page in a browser reaching the daemon through DNS rebinding.
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '[::1]')
+
+# Commands only the Unix socket takes. Pointing the daemon at another device
+# would let anything that can reach the HTTP port send requests anywhere.
+SOCKET_ONLY = ('device',)
+
+# Seconds a caller waits for its command to reach the front of the queue and
+# finish. Long text entry is the slowest thing there is.
+COMMAND_TIMEOUT = 60
+
+
+class CommandError(Exception):
+   """
+   Raised for commands the daemon does not understand or cannot carry out.
+   """
+
+
+class RemoteDaemon(object):
+   """
+   Class to hold the remote's state between commands. Commands from every
+   front end go through the shared rokucore command queue, so they reach the
+   Roku in the order they arrived.
+   """
+
+
+   def __init__(self, config_path=rokucore.CONFIG_PATH, device=None):
+       self.config_files = rokucore.get_config_files( config_path )
+       rokucore.use_config( self.config_files )
+
+       if device:
+           rokucore.select_device( device )
+       else:
+           address, model = rokucore.read_device_file( self.config_files['device'] )
+           rokucore.select_device( address, model )
+
+       if rokucore.roku_addr:
+           # Start from the cached catalog and open the connection now so
+           # the first command doesn't pay for it.
+           rokucore.load_channels()
+           rokucore.refresh_channels()
+
+
+   def run(self, func, *args):
+       """
+       Runs func(*args) on the command queue and waits for the result.
+       """
+       finished = threading.Event()
+       outcome  = {}
+
+       def done( result ):
+           outcome['result'] = result
+           finished.set()
+
+       def failed( err ):
+           outcome['error'] = err
+           finished.set()
+
+       rokucore.get_queue().submit( func, args, done=done, error=failed )
+       if not finished.wait( COMMAND_TIMEOUT ):
+           raise CommandError( "timed out waiting for the Roku" )
+       if 'error' in outcome:
+           raise CommandError( str(outcome['error']) )
+       return outcome.get('result')
+
+
+   def execute(self, command, argument=""):
+       """
+       Carries out one command and returns a JSON-friendly result.
+       """
+       if not rokucore.roku_addr and command not in ('device', 'status', 'macros', 'online'):
+           raise CommandError( "no device selected" )
+
+       if command in ('keypress', 'keydown', 'keyup'):
+           keys = argument.split()
+           for key in keys:
+               if key not in rokucore.KEYS and not key.startswith('Lit_'):
+                   raise CommandError( "'%s' not in valid key press list." % key )
+           if command == 'keypress':
+               # Several keys are one burst, pipelined with --batch.
+               self.run( rokucore.send_keys, rokucore.get_target(), keys )
+               return "ok"
+           for key in keys:
+               self.run( getattr(rokucore.get_target(), command), key )
+           return "ok"
+
+       if command == 'launch':
+           app_id = rokucore.channel_id( argument )
+           if app_id is None:
+               raise CommandError( '"%s" is not a valid channel!' % argument )
+           self.run( rokucore.get_target().launch, app_id )
+           return "ok"
+
+       if command == 'text':
+           self.run( rokucore.type_text, rokucore.get_target(), argument,
+                     rokucore.get_pacer() )
+           return "ok"
+
+       if command == 'macro':
+           try:
+               compiled = rokucore.get_macro( argument )
+           except SyntaxError as err:
+               # Channel names in the message may not be ASCII.
+               message = err.args[0]
+               if isinstance( message, unicode ):
+                   message = message.encode('utf-8')
+               raise CommandError( message )
+           self.run( rokucore.run_macro, rokucore.get_target(), compiled,
+                     rokucore.get_pacer() )
+           return "ok"
+
+       if command == 'macros':
+           return rokucore.macros
+
+       if command == 'channels':
+           return rokucore.channels
+
+       if command == 'refresh':
+           catalog = self.run( rokucore.get_channels )
+           rokucore.channels = catalog
+           rokucore.channels_hash = rokucore.catalog_hash( catalog )
+           rokucore.save_channels( rokucore.roku_addr, catalog )
+           return catalog
+
+       if command == 'device':
+           if argument:
+               rokucore.select_device( argument )
+               rokucore.load_channels()
+               rokucore.refresh_channels()
+           return rokucore.roku_addr
+
+       if command == 'online':
+           if not rokucore.listener:
+               raise CommandError( "not listening; start rokud with --listen" )
+           return [ { 'url'   : roku.url,
+                      'model' : roku.model_name,
+                      'name'  : roku.friendly_name } for roku in rokucore.listener.online() ]
+
+       if command == 'metrics':
+           return rokucore.stats.metrics_text()
+
+       if command == 'status':
+           skew = None
+           if rokucore.mirror_urls and rokucore.fanout:
+               skew = dict( zip( ('last', 'mean', 'worst'), rokucore.fanout.skew_stats() ))
+           return { 'device'   : rokucore.roku_addr,
+                    'model'    : rokucore.roku_model,
+                    'channels' : len(rokucore.channels),
+                    'mirrors'  : rokucore.mirror_urls,
+                    'skew'     : skew,
+                    'input'    : rokucore.get_inputs().counts(),
+                    'down'     : rokucore.is_down() }
+
+       raise CommandError( '"%s" is not a valid command.' % command )
+
+
+   def execute_line(self, line):
+       """
+       Carries out a command written as 'command argument...'. Returns the
+       reply line for the socket protocol.
+       """
+       parts = line.strip().split(None, 1)
+       if not parts:
+           return "error empty command"
+
+       command  = parts[0].lower()
+       argument = parts[1] if len(parts) > 1 else ""
+       try:
+           result = self.execute( command, argument )
+       except CommandError as err:
+           return "error %s" % err
+       return "ok %s" % json.dumps( result )
+
+
+class SocketHandler(SocketServer.StreamRequestHandler):
+   """
+   One command per line, one reply line per command. A connection may send
+   as many commands as it likes.
+   """
+
+
+   def handle(self):
+       for line in self.rfile:
+           self.wfile.write( self.server.daemon.execute_line(line) + "\n" )
+           self.wfile.flush()
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+   daemon_threads = True
+
+
+class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   """
+   HTTP front end. Paths mirror ECP where they can:
+
+      POST /keypress/<key>      POST /keydown/<key>       POST /keyup/<key>
+      POST /launch/<channel>    POST /text/<text>
+      POST /macro/<name>        POST /refresh
+      GET  /channels            GET  /macros              GET  /status
+      GET  /online              GET  /metrics
+
+   Requests from web pages are refused: anything with an Origin header, or
+   with a Host that isn't loopback. The device can only be changed over the
+   Unix socket.
+   """
+
+   protocol_version = 'HTTP/1.1'
+
+
+   def reply(self, code, result):
+       body = json.dumps( result )
+       self.send_response( code )
+       self.send_header( 'Content-Type', 'application/json' )
+       self.send_header( 'Content-Length', str(len(body)) )
+       self.end_headers()
+       self.wfile.write( body )
+
+
+   def from_browser(self):
+       """
+       Returns True if the request looks like it came from a web page.
+       """
+       if self.headers.getheader('Origin'):
+           return True
+
+       host = self.headers.getheader('Host')
+       if host is None:
+           return False
+       if not host.endswith(']'):
+           host = host.rsplit(':', 1)[0]
+       return host.lower() not in LOOPBACK_HOSTS
+
+
+   def dispatch(self):
+       parts    = self.path.lstrip('/').split('/', 1)
+       command  = parts[0]
+       argument = urllib.unquote( parts[1] ) if len(parts) > 1 else ""
+
+       if self.from_browser():
+           return self.reply( 403, { 'error': "requests from web pages are not accepted" } )
+       if command in SOCKET_ONLY:
+           return self.reply( 403, { 'error': '"%s" is only taken over the socket' % command } )
+
+       try:
+           if command == 'metrics':
+               # Served as plain text so scrapers can read it as is.
+               body = self.server.daemon.execute( command )
+               self.send_response( 200 )
+               self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+               self.send_header( 'Content-Length', str(len(body)) )
+               self.end_headers()
+               self.wfile.write( body )
+               return
+           self.reply( 200, self.server.daemon.execute(command, argument) )
+       except CommandError as err:
+           self.reply( 400, { 'error': str(err) } )
+
+
+   def do_GET(self):
+       self.dispatch()
+
+
+   def do_POST(self):
+       # Commands carry no body, but drain one if a client sent it anyway.
+       length = int( self.headers.getheader('Content-Length') or 0 )
+       if length:
+           self.rfile.read( length )
+       self.dispatch()
+
+
+   def log_message(self, format, *args):
+       # Keep quiet; hotkeys fire a lot of these.
+       pass
+
+
+class HttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+
+
+def serve( daemon, socket_file=SOCKET_FILE, http_port=HTTP_PORT ):
+   """
+   Starts the front ends and serves until interrupted.
+   """
+   servers = []
+
+   if socket_file:
+       # A stale socket from an earlier run would stop the bind.
+       if op.exists( socket_file ):
+           os.unlink( socket_file )
+       if not op.isdir( op.dirname(socket_file) ):
+           os.makedirs( op.dirname(socket_file) )
+       unix_server = UnixServer( socket_file, SocketHandler )
+       os.chmod( socket_file, 0600 )
+       servers.append( unix_server )
+
+   if http_port:
+       servers.append( HttpServer( ('127.0.0.1', http_port), HttpHandler ) )
+
+   threads = []
+   for server in servers:
+       server.daemon = daemon
+       thread = threading.Thread( target=server.serve_forever )
+       thread.daemon = True
+       thread.start()
+       threads.append( thread )
+
+   try:
+       while True:
+           for thread in threads:
+               thread.join( 1 )
+   except KeyboardInterrupt:
+       if sys.stdout:
+           sys.stdout.write( "Quitting...\n" )
+   finally:
+       for server in servers:
+           server.shutdown()
+       if socket_file and op.exists( socket_file ):
+           os.unlink( socket_file )
+
+
+def main( argv ):
+   parser = argparse.ArgumentParser( description="Resident Roku remote." )
+   parser.add_argument( '-d', '--device', help="ECP address of the Roku" )
+   parser.add_argument( '-c', '--config', default=rokucore.CONFIG_PATH,
+                        help="configuration directory (default: %(default)s)" )
+   parser.add_argument( '-s', '--socket', default=SOCKET_FILE,
+                        help="Unix socket to listen on, '' to disable (default: %(default)s)" )
+   parser.add_argument( '-l', '--listen', action='store_true',
+                        help="keep a live list of the Rokus on the network" )
+   parser.add_argument( '-b', '--batch', type=int, default=1,
+                        help="keys per pipelined batch for keypress bursts (default: %(default)s)" )
+   parser.add_argument( '-p', '--port', type=int, default=HTTP_PORT,
+                        help="local HTTP port, 0 to disable (default: %(default)s)" )
+   args = parser.parse_args( argv )
+
+   rokucore.pipeline_batch = args.batch
+   if args.listen:
+       rokucore.start_listener()
+   rokucore.start_monitor()
+   serve( RemoteDaemon(args.config, args.device), args.socket, args.port )
+   return 0
+
+
+#
+# Invocation Check:
+#
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
@@ -36,141 +36,174 @@
 import pygtk
 pygtk.require('2.0')
 import gtk
-import re
+import gobject
 import sys
-import time
 import yaml
-import fcntl
-import socket
-import struct
-import requests
+import bisect
 import threading
 
-MAX_ROKUS = 3
+# The GUI-free half of the library. Its names are re-exported here so the
+# GTK code (and saved launcher files) can keep using rokulib.
+import rokucore
+from rokucore import Roku, Launcher, DeviceSet, check_key
+from rokucore import get_client, get_target, get_queue, get_pacer
+from rokucore import report_error, load_channels, type_text
+from rokucore import get_macro, run_macro, get_inputs, get_icons
+from rokucore import device_sort_key, find_rokus, list_interfaces, detect_ethernet
+
+# Results of queued commands are handed back on the GTK main loop.
+rokucore.notify = gobject.idle_add
+
 selected_roku = None
-class Roku(object):
-   """
-   Class to contain data for the Rokus on the network.
-   """
 
-   DIAL_URN = 'dial/dd.xml'
+# Rokus ticked for mirroring in the device dialog.
+mirror_choice = {}
+
+# Keys held down on the Roku, mapped to the timer of a pending release.
+held_keys = {}
 
+# Milliseconds a keyboard key release is put off. X auto-repeat sends a
+# release and a press for every repeat, and those releases must not reach
+# the Roku or it would stop repeating on its own.
+REPEAT_GRACE = 40
 
-   def __init__(self, url):
-       self.url = url
+# Keyboard keys that work like the D-pad.
+ARROW_KEYS = { gtk.keysyms.Up   : "Up",   gtk.keysyms.Down  : "Down",
+               gtk.keysyms.Left : "Left", gtk.keysyms.Right : "Right" }
+
+# Size channel icons are shown at in the channel grid. Roku icons are 4:3.
+ICON_WIDTH  = 96
+ICON_HEIGHT = 72
+
+
+def keypress( button ):
+   """
+   Returns a callback that will press the specifed button.
+   """
 
+   check_key( button )
 
-   def __str__(self):
-       return "%s" % self.url
 
+   def callback_function( rcbutton ):
+       """
+       Calback function bound to the button to press.
+       """
+       rokucore.record_command( 'keypress', button )
+       if not get_inputs().push( 'keypress', button ):
+           gtk.gdk.beep()
 
-   def __repr__(self):
+   # Return the callback
+   return callback_function
 
 
-       if self.friendly_name:
-           return "%s (%s)" % (self.friendly_name, self.url)
-       if self.model_name:
-           return "%s (%s)" % (self.model_name, self.url)
-       return "%s" % self.url
+def hold( button ):
+   """
+   Returns callbacks for a button's 'pressed' and 'released' signals that
+   hold the key down on the Roku for as long as the button is, so a held
+   button costs two requests and the Roku does the repeating.
+   """
 
+   check_key( button )
 
-   def get_dial_data(self):
+
+   def pressed_function( rcbutton ):
        """
-       Parses the DIAL config file from the Roku to find parameters of interest.
+       Callback function bound to the button press.
        """
-       code = requests.get( self.url + self.DIAL_URN )
-
-       name_map = {
-           '3100X' : 'Roku 2 XS',
-           '4200X' : 'Roku 3',
-       }
-
-       # Items of interest:
-       # <friendlyName>
-       # <modelName>
-       # <modelNumber>
-       # <serialNumber>
-       for line in code.iter_lines():
-           name_match    = re.search( '<friendlyName>(.*)</friendlyName>', line )
-           mod_match     = re.search( '<modelNumber>(.*)</modelNumber>'  , line )
-           mod_num_match = re.search( '<modelName>(.*)</modelName>'      , line )
-           ser_num_match = re.search( '<serialNumber>(.*)</serialNumber>', line )
-
-           if name_match:
-               self.friendly_name = name_match.group(1)
-               continue
+       key_down( button )
 
-           if mod_match:
-               self.model_name = mod_match.group(1)
-               if self.model_name in name_map:
-                   self.model_name = name_map[self.model_name]
-               continue
 
-           if mod_num_match:
-               self.model_number = mod_num_match.group(1)
-               continue
+   def released_function( rcbutton ):
+       """
+       Callback function bound to the button release.
+       """
+       key_up( button )
 
-           if ser_num_match:
-               self.serial_number = ser_num_match.group(1)
-               continue
+   # Return the callbacks
+   return pressed_function, released_function
 
 
-class Launcher(object):
+def key_down( button ):
    """
-   Class to contain data for the channel launcher buttons.
+   Holds a key down on the Roku. Repeated presses of a key that is already
+   held only cancel its pending release.
    """
+   if button in held_keys:
+       if held_keys[button]:
+           gobject.source_remove( held_keys[button] )
+           held_keys[button] = None
+       return
 
+   # A full input queue means the Roku is falling behind. Say so rather
+   # than hold a key it may not get to for seconds.
+   if not get_inputs().push( 'keydown', button ):
+       gtk.gdk.beep()
+       return
 
-   def __init__(self, disp_name, chan_name=None):
-       if not chan_name:
-           self.disp_name = disp_name
-           self.chan_name = disp_name
-           return
-       self.disp_name  = disp_name
-       self.chan_name  = chan_name
-       self.button_ref = None
+   held_keys[button] = None
+   rokucore.record_command( 'keydown', button )
 
 
-def keypress( button ):
+def key_up( button, delay=0 ):
    """
-   Returns a callback that will press the specifed button.
+   Releases a held key, after delay milliseconds if one is given.
    """
-
-   # These are keys recognized by the Roku ECP.
-   keys = ["Home", "Rev", "Fwd", "Play", "Select", "Left", "Right",
-           "Down", "Up", "Back", "Info", "Backspace", "Search", "Enter"]
-
-   if button not in keys:
-       error = "'%s' not in valid key press list." % button
-       raise SyntaxError, error
+   if button not in held_keys:
+       return
 
 
-   def callback_function( rcbutton ):
+   def release():
        """
-       Calback function bound to the button to press.
+       Sends the release. Returns False so the timer only fires once.
        """
-       requests.post( roku_addr + '/keypress/' + button )
+       del held_keys[button]
+       get_inputs().push( 'keyup', button )
+       rokucore.record_command( 'keyup', button )
+       return False
 
-   # Return the callback
-   return callback_function
+   if not delay:
+       release()
+   elif not held_keys[button]:
+       held_keys[button] = gobject.timeout_add( delay, release )
 
 
-def get_channels():
+def release_keys( *args ):
    """
-   Queries the channels installed on the targeted Roku.
+   Releases every held key at once, e.g. when the window loses focus and
+   would never see the key come back up.
    """
+   for button in list( held_keys ):
+       if held_keys[button]:
+           gobject.source_remove( held_keys[button] )
+       held_keys[button] = None
+       key_up( button )
+   return False
 
-   code = requests.get(roku_addr + "/query/apps")
 
-   channels = {}
+def arrow_pressed( window, event ):
+   """
+   Callback for key presses in the main window. Arrow keys hold the same
+   key on the Roku unless the text box is being edited.
+   """
+   if event.keyval not in ARROW_KEYS:
+       return False
+   if isinstance( window.get_focus(), gtk.Entry ):
+       return False
+
+   key_down( ARROW_KEYS[event.keyval] )
+   return True
 
-   for channel in code.iter_lines():
-       app_id = re.search(r'<app id=("\d+?")', channel)
-       name   = re.search(r'>([A-Za-z0-9\s\.\-]+?)</app>', channel)
-       if app_id and name:
-           channels[name.group(1)] = app_id.group(1)
 
-   return channels
+def arrow_released( window, event ):
+   """
+   Callback for key releases in the main window.
+   """
+   button = ARROW_KEYS.get( event.keyval )
+   if button not in held_keys:
+       return False
+
+   key_up( button, REPEAT_GRACE )
+   return True
 
 
 def launch( channel ):
@@ -183,8 +216,12 @@ def launch( channel ):
        """
        Callback function bound to the channel launcher.
        """
+       def launch_failed( err ):
+           rcbutton.set_label("ERROR!")
+           report_error( err )
+
        try:
-           code = requests.post(roku_addr + "/launch/" + channels[channel].strip('"'))
+           app_id = rokucore.channels[channel].strip('"')
        except KeyError as err:
            # Ensure that the button text will change even if there is no stderr.
            button = rcbutton.set_label("ERROR!")
@@ -192,14 +229,56 @@ def launch( channel ):
                sys.stderr.write( '"%s" is not a valid channel!\n' % channel )
                sys.stderr.write( 'Please update your saved channel configuration.\n\n')
                sys.stderr.write( 'Valid channels:\n' )
-               for chan in channels:
+               for chan in rokucore.channels:
                    sys.stderr.write( ' - "%s"\n' % chan )
            return
 
+       rokucore.record_command( 'launch', channel )
+       get_queue().submit( get_target().launch, (app_id,), error=launch_failed )
+
+   # Return the callback
+   return callback_function
+
+
+def macro( name ):
+   """
+   Returns a callback that will play the named macro.
+   """
+
+
+   def callback_function( rcbutton ):
+       """
+       Callback function bound to the macro launcher.
+       """
+       def macro_failed( err ):
+           rcbutton.set_label("ERROR!")
+           report_error( err )
+
+       # The macro is looked up when clicked so edits to it take effect
+       # without rebinding the button.
+       try:
+           compiled = get_macro( name )
+       except SyntaxError as err:
+           macro_failed( err )
+           return
+
+       get_queue().submit( run_macro, (get_target(), compiled, get_pacer()),
+                           error=macro_failed )
+
    # Return the callback
    return callback_function
 
 
+def launcher_command( launcher ):
+   """
+   Returns the command a launcher button is registered with. A channel name
+   of 'macro <name>' plays a saved macro instead of launching a channel.
+   """
+   if launcher.chan_name and launcher.chan_name.split(None, 1)[0] == "macro":
+       return launcher.chan_name
+   return "launch %s" % launcher.chan_name
+
+
 def layout_remote_buttons( buttons ):
    """
    Positions buttons in a fixed location.
@@ -282,7 +361,7 @@ def layout_remote_buttons( buttons ):
            this_button.y_pos = utl_lnch_row + utl_lnch_row_off
 
            this_button.set_label( launchers[launch_count].disp_name )
-           this_button.register("launch %s" % launchers[launch_count].chan_name )
+           this_button.register( launcher_command(launchers[launch_count]) )
            launchers[launch_count].button_ref = this_button
            launch_count += 1
            launch_bias  += 1
@@ -333,20 +412,18 @@ def send_text( text_box ):
    Handle sending text from text box to the Roku. This function will not
    automatically send the selection because the Roku protocol is unreliable and
    may miss key presses (especially for long strings). Sending an empty string
-   will force the selection.
+   will force the selection. Characters are paced by get_pacer() to suit the
+   selected model.
    """
+   client = get_target()
    text = text_box.get_text()
    if text == "":
-       requests.post( roku_addr + "/keypress/Enter" )
+       get_queue().submit( client.keypress, ("Enter",) )
        return
 
-   for letter in text:
-       if letter == ' ':
-           letter = '%20'
-       requests.post( roku_addr + "/keypress/Lit_" + letter )
-       time.sleep(.3)
-
-   # Clear the text box.
+   # The characters are paced out on the command thread. The box can be
+   # cleared right away since the text has already been captured.
+   get_queue().submit( type_text, (client, text, get_pacer()) )
    text_box.set_text("")
 
 
@@ -356,7 +433,7 @@ def send_backspace( text_box ):
    differently for a reason... I'm sure.
    """
 
-   requests.post( roku_addr + "/keypress/Backspace" )
+   get_queue().submit( get_target().keypress, ("Backspace",) )
 
 
 def choose_device( main_window, config_files ):
@@ -368,8 +445,6 @@ def choose_device( main_window, config_files ):
    # Create the device discovery window.
    dev_window = gtk.Dialog( title= "Find Devices", parent=main_window   )
 
-   # Create a pane to contain widgets.
-   pane = gtk.Fixed()
    save = gtk.Button(label="Save" )
    save.set_size_request( 75,35 )
 
@@ -377,82 +452,142 @@ def choose_device( main_window, config_files ):
    save_args = (update_vars, config_files['device'], dev_window, main_window)
    save.connect( 'clicked', save_dev_selection, save_args )
 
-   # Request a size and inhibit resizing.
-   dev_window.set_size_request( 400, 150 )
-   dev_window.set_resizable( False )
-
+   # There is no limit on how many devices may answer, so they are listed in
+   # a scrolling box rather than placed at fixed offsets.
+   dev_window.set_default_size( 400, 250 )
 
    # Create the label to show the search/select text.
    label = gtk.Label("Please Select a device:")
-   pane.put(label ,  10, 10 )
-   pane.put(save  , 305, 80 )
+   label.set_alignment( 0, 0.5 )
+   hint = gtk.Label("Tick 'Mirror' to send every command to more devices.")
+   hint.set_alignment( 0, 0.5 )
+
+   dev_list = gtk.VBox( spacing=2 )
+   scroller = gtk.ScrolledWindow()
+   scroller.set_policy( gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC )
+   scroller.add_with_viewport( dev_list )
 
    # Dialog boxes default with a VBox and HBox.
-   dev_window.vbox.pack_start(pane)
+   dev_window.vbox.pack_start( label, expand=False, padding=5 )
+   dev_window.vbox.pack_start( scroller )
+   dev_window.vbox.pack_start( hint, expand=False, padding=5 )
+   dev_window.action_area.pack_end( save )
 
    # Show the widgets.
-   dev_window.show_now()
-   save.show()
-   pane.show_now()
-   label.show_now()
+   dev_window.show_all()
 
 
-   # Get a list of the Roku devices on the network.
-   rokus = []
-   find_complete = threading.Event()
+   # Start with nothing selected. Devices are added as they answer.
+   selected_roku = None
+   mirror_choice.clear()
+   rokus  = DeviceSet()
+   layout = { 'leader': None, 'closed': False, 'shown': set(), 'order': [] }
 
-   # Guess which Ethernet interface to use.
-   eth_if = detect_ethernet()
-
-   # No interface could be found. Stop.
-   if eth_if == 'NO_IF':
+   # The search goes out on every interface that can reach a Roku. With
+   # none, stop.
+   if not list_interfaces():
        label.set_text( "No Network Interface Found!")
        save.hide()
        return
 
-   find_thread = threading.Thread(target=find_rokus, args=(eth_if, rokus, find_complete ))
-   find_thread.start()
+   label.set_text( "Searching for devices..." )
 
-   # Wait for the find thread to report completion.
-   find_complete.wait()
-   x_pos = 10
-   y_pos = 25
-   y_off = 20
+   def window_closed( widget ):
+       layout['closed'] = True
 
-   # Setup radio button selection for device list.
-   if len( rokus ) == 0:
-       label.set_text( "No Devices Found!")
-       return
+   dev_window.connect( 'destroy', window_closed )
 
-   if len( rokus ) == 1:
-       label.set_text( "Selected Device: " )
-       dev = gtk.RadioButton(group=None, label="%s (%s)" % ( rokus[0].model_name ,
-                                                             rokus[0].friendly_name ))
-       dev.set_active(True)
-       dev.show()
-       pane.put( dev, x_pos, y_pos )
-       selected_roku = rokus[0]
-       return
+   def add_device( roku ):
+       """
+       Adds a radio button for a newly discovered Roku. Runs on the main loop.
+       """
+       global selected_roku
+
+       if layout['closed']:
+           return False
 
+       # Devices known from the registry may answer the search as well.
+       key = roku.usn or roku.url
+       if key in layout['shown']:
+           return False
+       layout['shown'].add( key )
 
-   # More than 1 Roku was found, there needs to be list.
-   for ind in range(0, len(rokus)):
-       # First device sets up the button group.
-       if ind == 0:
-           dev = gtk.RadioButton(group=None, label="%s (%s)" % ( rokus[ind].model_name,
-                                                                 rokus[ind].friendly_name ))
+       dev = gtk.RadioButton(group=layout['leader'],
+                             label="%s (%s)" % ( roku.model_name or roku.url,
+                                                 roku.friendly_name or '' ))
+       dev.set_alignment( 0, 0.5 )
+
+       # First device sets up the button group and is selected by default.
+       if layout['leader'] is None:
+           layout['leader'] = dev
            dev.set_active(True)
-           leader = dev
-           selected_roku = rokus[ind]
-       else:
-           dev = gtk.RadioButton(group=leader, label="%s (%s)" % ( rokus[ind].model_name,
-                                                                   rokus[ind].friendly_name ))
+           selected_roku = roku
+           label.set_text( "Please Select a device:" )
 
        # Register the callback function that selects the Roku.
-       dev.connect('toggled', rb_toggled, (rokus[ind],))
-       pane.put( dev, x_pos, y_pos )
-       dev.show()
-       y_pos += y_off
+       dev.connect('toggled', rb_toggled, (roku,))
+
+       # Any number of devices may be ticked to mirror the selected one.
+       mirror = gtk.CheckButton( label="Mirror" )
+       mirror.set_active( roku.url in rokucore.mirror_urls )
+       if mirror.get_active():
+           mirror_choice[roku.url] = roku
+       mirror.connect('toggled', mirror_toggled, (roku,))
+
+       row = gtk.HBox()
+       row.pack_start( dev )
+       row.pack_end( mirror, expand=False )
+
+       # Keep the list sorted as devices trickle in.
+       sort_key = device_sort_key( roku )
+       position = bisect.bisect( layout['order'], sort_key )
+       layout['order'].insert( position, sort_key )
+       dev_list.pack_start( row, expand=False )
+       dev_list.reorder_child( row, position )
+       row.show_all()
+       return False
+
+   def search_done():
+       """
+       Updates the label once the search is over. Runs on the main loop.
+       """
+       if layout['closed']:
+           return False
+
+       if layout['leader'] is None:
+           label.set_text( "No Devices Found!")
+       return False
+
+   def device_found( roku ):
+       if rokucore.listener:
+           rokucore.listener.add( roku )
+       gobject.idle_add( add_device, roku )
+
+   # Devices the listener has heard from are online right now, and known
+   # devices are likely to be; both are listed straight away and the
+   # search revalidates them.
+   if rokucore.listener:
+       for roku in rokucore.listener.online():
+           add_device( roku )
+
+   registry = rokucore.registry
+   if registry:
+       for roku in registry.known():
+           add_device( roku )
+
+   # The whole point is to find devices that aren't known yet, so the search
+   # runs its full course rather than stopping when the known ones answer.
+   def find_devices():
+       try:
+           find_rokus( None, rokus, found=device_found, registry=registry )
+       finally:
+           gobject.idle_add( search_done )
+
+   # Discovery runs in the background so the dialog stays live. The user may
+   # pick a device and save before the search has finished.
+   find_thread = threading.Thread(target=find_devices, name="find-rokus")
+   find_thread.daemon = True
+   find_thread.start()
 
 
 def update_vars():
@@ -460,11 +595,10 @@ def update_vars():
    This function is used to refresh environment data. Symbols bound during
    signal connection may be stale when the callback is invoked at run time.
    """
-   global roku_addr
    global selected_roku
 
    # Refresh the Roku Address
-   roku_addr = selected_roku.url
+   rokucore.select_device( selected_roku.url, selected_roku.model_name )
 
 
 def save_dev_selection( widget, data ):
@@ -474,6 +608,10 @@ def save_dev_selection( widget, data ):
 
    global selected_roku
 
+   # Nothing has been found (yet) to save.
+   if selected_roku is None:
+       return
+
    # Unpack the arguments.
    update_vars   = data[0]
    dev_file_name = data[1]
@@ -495,8 +633,19 @@ def save_dev_selection( widget, data ):
    yaml.dump_all( data, dev_file )
    dev_file.close()
 
+   # Commands go to the selected device plus any ticked for mirroring.
+   mirrors = [ url for url in mirror_choice if url != selected_roku.url ]
+   rokucore.mirror_urls = mirrors
+
+   # Switch to the new device's channels, starting from its cached catalog.
+   load_channels()
+   rokucore.refresh_channels( rebind_launchers )
+
    # Set the main window's title to match the chosen device.
-   main_window.set_title( "Roku Remote: %s" % selected_roku.model_name )
+   title = "Roku Remote: %s" % selected_roku.model_name
+   if mirrors:
+       title += " (+%d mirrored)" % len(mirrors)
+   main_window.set_title( title )
    dev_window.destroy()
 
 
@@ -511,86 +660,16 @@ def rb_toggled(widget, data):
        selected_roku = data[0]
 
 
-def find_rokus( net, devices=[], event=None ):
+def mirror_toggled(widget, data):
    """
-   Send out an SSDP packet requesting Rokus to identify themselves.
+   Adds or removes a Roku from the mirroring group when its box is ticked.
    """
+   roku = data[0]
 
-   # Set the Multicast address and port for UPnP
-   MULTICAST_ADDR = '239.255.255.250'
-   MULTICAST_PORT = 1900
-
-   # Timout in seconds.
-   TIMEOUT = 2.5
-
-   # DISCOVER will look for all Roku ECP devices.
-   DISCOVER =  'M-SEARCH * HTTP/1.1\r\n' +\
-               'HOST:%s:%s\r\n' % (MULTICAST_ADDR, MULTICAST_PORT) +\
-               'ST:roku:ecp\r\n'         +\
-               'MX:2\r\n'                +\
-               'MAN:"ssdp:discover"\r\n'
-
-   # Set socket timer to TIMEOUT seconds, any blocking operation on sockets will
-   # abort if TIMEOUT seconds elapse.
-   socket.setdefaulttimeout(TIMEOUT)
-
-   # Get the IP address of the active interface. The null_socket is never bound
-   # or used, other than to get the address.
-   null_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-   loc_addr =  socket.inet_ntoa(fcntl.ioctl(null_socket.fileno(), 0x8915, struct.pack('256s', net[:15]))[20:24])
-
-   # Setup and send the MULTICAST request
-   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-
-   # Manually change the multicast interface to the chosen one.
-   sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, 
-                   socket.inet_aton(loc_addr))
-
-   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-   sock.bind((loc_addr, MULTICAST_PORT))
-
-   # Ask politely to join the multicast group.
-   multicast_request = struct.pack('4sl', socket.inet_aton(MULTICAST_ADDR), 
-                                   socket.INADDR_ANY)
-
-   sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, 
-                   multicast_request)
-
-   # Send the DISCOVER string to look for UPnP devices on the network.
-   sock.sendto(DISCOVER, (MULTICAST_ADDR, MULTICAST_PORT))
-   raw_devices = []
-   found = 0
-
-   while True:
-       try:
-           # Try to receive data from any UPnP devices on the network.
-           raw_devices.append( sock.recv(1024) )
-       except socket.timeout:
-           # Break out when no more devices respond.
-           break
-       found += 1
-
-   # Sometimes devices will respond multiple times. Build a final list of devices.
-   for device in raw_devices:
-
-       # Search through the device information looking for key data.
-       location = re.search(r'location:\s*(.*)', device, re.IGNORECASE)
-       usn = re.search(r'usn:\s*(.*)', device, re.IGNORECASE)
-       st  = re.search(r'st:\s*(.*)', device, re.IGNORECASE)
-
-       if location and usn and st:
-           device_data = ()
-           device_data = (location.group(1).strip('\r\n'),
-                          usn.group(1).strip('\r\n'),
-                          st.group(1).strip('\r\n'))
-
-       if (device_data not in devices) and len(devices) < MAX_ROKUS:
-           roku = Roku(device_data[0])
-           roku.get_dial_data()
-           devices.append(roku)
-
-   # Set the event so the main thread knows to continue.
-   event.set()
+   if widget.get_active():
+       mirror_choice[roku.url] = roku
+   else:
+       mirror_choice.pop( roku.url, None )
 
 
 def choose_launchers( main_window, config_files ):
@@ -612,7 +691,7 @@ def choose_launchers( main_window, config_files ):
    # Create the label to show the search/select text.
    window_label   = gtk.Label("Edit Quick Launch Settings:")
    disp_col_label = gtk.Label("Display Name")
-   chan_col_label = gtk.Label("Channel Name")
+   chan_col_label = gtk.Label("Channel Name (or macro <name>)")
    save_button    = gtk.Button(label="Save")
 
    title_row = 35
@@ -687,11 +766,7 @@ def save_launch_file( widget, data ):
        launchers[count].chan_name = text_boxes[count][1].get_text()
 
        # Reset the display name and re-register the callback for the new channel.
-       if launchers[count].button_ref:
-           launchers[count].button_ref.set_label( launchers[count].disp_name )
-           if launchers[count].button_ref.handler:
-               launchers[count].button_ref.disconnect( launchers[count].button_ref.handler )
-           launchers[count].button_ref.register("launch %s" % launchers[count].chan_name )
+       rebind_launcher( launchers[count] )
 
    try:
        launch_file = open(launch_file_name, 'w')
@@ -705,27 +780,182 @@ def save_launch_file( widget, data ):
    window.destroy()
 
 
-def detect_ethernet():
+def rebind_launcher( launcher ):
    """
-   Uses /proc/net/dev to determine which Ethernet interface to use.
+   Resets a launcher button's label and re-registers its launch callback.
    """
-   net_file = open('/proc/net/dev', 'r')
+   button = getattr( launcher, 'button_ref', None )
+   if not button:
+       return
 
-   # These are the first fields in rows we're not interested in.
-   rejects = ['Inter-|', 'face', 'lo:']
-   for line in net_file:
+   button.set_label( launcher.disp_name )
+   if button.handler:
+       button.disconnect( button.handler )
+   button.register( launcher_command(launcher) )
 
-       data = line.split()
-       if data[0] in rejects:
-           continue
 
-       # Chop the ':' from the device name.
-       name = data[0][:-1]
+def rebind_launchers():
+   """
+   Rebinds every launcher button, e.g. after the channel catalog changed.
+   """
+   if not launchers:
+       return
 
-       # Check for a interface that has transmitted.
-       tx_bytes = int(data[9])
+   for each in launchers:
+       rebind_launcher( launchers[each] )
 
-       if tx_bytes > 0:
-           return name
 
-   return 'NO_IF'
+def record_macro( main_window, recording ):
+   """
+   Starts recording button presses, or stops and asks what to call the macro.
+   """
+   if recording:
+       rokucore.start_recording()
+       return
+
+   steps = rokucore.stop_recording()
+   if not steps:
+       return
+
+   name_window = gtk.Dialog( title="Save Macro", parent=main_window )
+   name_window.set_resizable( False )
+
+   name_label  = gtk.Label("Macro Name:")
+   name_box    = gtk.Entry(max=64)
+   step_label  = gtk.Label("%d steps recorded." % len(steps))
+   save_button = gtk.Button(label="Save")
+   save_button.set_size_request( 75, 35 )
+
+   name_window.vbox.pack_start( name_label )
+   name_window.vbox.pack_start( name_box )
+   name_window.vbox.pack_start( step_label )
+   name_window.action_area.pack_start( save_button )
+
+   save_args = ( name_box, steps, name_window )
+   save_button.connect( "clicked", save_macro, save_args )
+   name_box.connect( "activate", save_macro, save_args )
+
+   name_window.show_all()
+
+
+def save_macro( widget, data ):
+   """
+   Responds to the 'Save' button click event on the macro name dialog.
+   """
+   name_box, steps, window = data
+
+   name = name_box.get_text().strip()
+   if not name:
+       return
+
+   rokucore.add_macro( name, steps )
+   window.destroy()
+
+
+def icon_pixbuf( data ):
+   """
+   Returns icon data as a pixbuf scaled to fit the channel grid, or None if
+   it isn't an image.
+   """
+   loader = gtk.gdk.PixbufLoader()
+   try:
+       loader.write( data )
+       loader.close()
+   except gobject.GError:
+       return None
+
+   pixbuf = loader.get_pixbuf()
+   if not pixbuf:
+       return None
+
+   scale  = min( float(ICON_WIDTH) / pixbuf.get_width(),
+                 float(ICON_HEIGHT) / pixbuf.get_height() )
+   width  = max( 1, int(pixbuf.get_width() * scale) )
+   height = max( 1, int(pixbuf.get_height() * scale) )
+   return pixbuf.scale_simple( width, height, gtk.gdk.INTERP_BILINEAR )
+
+
+def show_channels( main_window ):
+   """
+   Displays every installed channel as a grid of icons. Activating one
+   launches it. Icons are only fetched for the channels in view, and come
+   from the icon cache when they can.
+   """
+   grid_window = gtk.Dialog( title="Channels", parent=main_window )
+   grid_window.set_size_request( 600, 400 )
+
+   # A blank stand-in keeps the grid from jumping as icons arrive.
+   blank = gtk.gdk.Pixbuf( gtk.gdk.COLORSPACE_RGB, True, 8, ICON_WIDTH, ICON_HEIGHT )
+   blank.fill( 0 )
+
+   # Icon, channel name and application id.
+   store = gtk.ListStore( gtk.gdk.Pixbuf, str, str )
+   for name in sorted( rokucore.channels, key=lambda name: name.lower() ):
+       store.append( [ blank, name, rokucore.channels[name].strip('"') ] )
+
+   if not len(store):
+       grid_window.vbox.pack_start( gtk.Label("No channels yet. Pick a Roku with Find Devices.") )
+       grid_window.show_all()
+       return
+
+   grid = gtk.IconView( store )
+   grid.set_pixbuf_column( 0 )
+   grid.set_text_column( 1 )
+   grid.set_item_width( ICON_WIDTH + 20 )
+
+   scroller = gtk.ScrolledWindow()
+   scroller.set_policy( gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC )
+   scroller.add( grid )
+   grid_window.vbox.pack_start( scroller )
+
+   # Rows whose icon has been asked for, and the rows in view.
+   requested = set()
+   in_view   = [0, -1]
+
+   def wanted( row ):
+       """
+       Returns a check, run just before the fetch, that the row is still in
+       view. Rows that scrolled away can be asked for again later.
+       """
+       def check():
+           if in_view[0] <= row <= in_view[1]:
+               return True
+           requested.discard( row )
+           return False
+       return check
+
+   def icon_loaded( row ):
+       def callback( data ):
+           pixbuf = icon_pixbuf( data )
+           if pixbuf:
+               store[row][0] = pixbuf
+       return callback
+
+   def load_visible( *args ):
+       span = grid.get_visible_range()
+       if not span:
+           return False
+
+       in_view[:] = [ span[0][0], span[1][0] ]
+       for row in range( span[0][0], span[1][0] + 1 ):
+           if row in requested:
+               continue
+           requested.add( row )
+           app_id = store[row][2]
+           get_icons().request( app_id, rokucore.channel_versions.get(app_id),
+                                icon_loaded(row), wanted(row) )
+       return False
+
+   def channel_chosen( icon_view, path ):
+       # The store hands back UTF-8; the catalog is keyed by unicode.
+       name, app_id = store[path][1].decode('utf-8'), store[path][2]
+       rokucore.record_command( 'launch', name )
+       get_queue().submit( get_target().launch, (app_id,) )
+       grid_window.destroy()
+
+   # The visible range is only known once the grid is laid out, so it is
+   # checked whenever the grid is drawn.
+   grid.connect_after( "expose-event", load_visible )
+   grid.connect( "item-activated", channel_chosen )
+
+   grid_window.show_all()